@@ -1,18 +1,24 @@
 import io
 import json
 import re
-import subprocess
 import tomllib
-from typing import Optional, Union, Dict, List, Tuple
+from typing import Optional, Union, Dict, List, Tuple, AsyncIterable, AsyncIterator
 import time
 from dataclasses import dataclass, field
 from datetime import datetime
 import asyncio
-from collections import defaultdict
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from collections import defaultdict, OrderedDict
 from enum import Enum
 import urllib.parse
 import mimetypes
 import base64
+import functools
+import hashlib
+import mmap
+import uuid
+import wave
 
 import aiohttp
 import filetype
@@ -41,16 +47,51 @@ except ImportError:
     has_api_proxy = False
     logger.warning("未找到API管理中心集成模块，Dify插件将使用直接连接")
 
+# 可选的进程内 SILK 解码器，未安装时使用 ffmpeg
+try:
+    import pysilk
+    has_silk_decoder = True
+except ImportError:
+    has_silk_decoder = False
+    logger.info("未安装 silk-python，语音将通过 ffmpeg 解码")
+
 # 常量定义
 XYBOT_PREFIX = "-----老夏的金库-----\n"
 DIFY_ERROR_MESSAGE = "🙅对不起，Dify出现错误！\n"
 INSUFFICIENT_POINTS_MESSAGE = "😭你的积分不够啦！需要 {price} 积分"
 VOICE_TRANSCRIPTION_FAILED = "\n语音转文字失败"
 TEXT_TO_VOICE_FAILED = "\n文本转语音失败"
+VOICE_TRANSCRIPTION_BUSY = "语音识别繁忙，请稍后再试或直接发送文字"
 CHAT_TIMEOUT = 3600  # 1小时超时
 CHAT_AWAY_TIMEOUT = 1800  # 30分钟自动离开
 MESSAGE_BUFFER_TIMEOUT = 10  # 消息缓冲区超时时间（秒）
 MAX_BUFFERED_MESSAGES = 10  # 最大缓冲消息数
+IMAGE_MAX_DIMENSION = 1600  # 图片最大边长限制
+WECHAT_IMAGE_FORMATS = ("JPEG", "PNG", "GIF")  # 可以直接发送给微信的图片格式
+WECHAT_IMAGE_MAX_BYTES = 10 * 1024 * 1024  # 直接发送给微信的图片大小上限
+MEDIA_CACHE_SWEEP_INTERVAL = 30  # 媒体缓存后台清理间隔（秒）
+SPILL_FILE_PREFIX = "dify_cache_"  # 落盘缓存文件名前缀
+UPLOAD_CHUNK_SIZE = 256 * 1024  # 流式上传的分块大小
+DOWNLOAD_SECTION_SIZE = 64 * 1024  # DownloadFile 初始分段大小
+DOWNLOAD_SECTION_RETRIES = 3  # 单个分段的最大重试轮数
+XML_FILE_TYPE_PATTERN = re.compile(r"<type>\s*6\s*</type>")  # 文件类型 appmsg 的快速匹配
+VOICE_SAMPLE_RATE = 16000  # 语音识别使用的采样率
+VOICE_SAMPLE_WIDTH = 2  # 语音识别使用的采样位宽（字节）
+VOICE_TRANSCODE_TIMEOUT = 30  # 单条语音转码超时（秒）
+TTS_SENTENCE_END_PATTERN = re.compile(r"[。！？!?；;…\n]+")  # 语音合成分段使用的句末标点
+TTS_SOFT_BREAKS = "，,、：: "  # 过长的句子在这些字符处切开
+TTS_SEGMENT_MIN_CHARS = 12  # 语音分段的最小长度，过短的句子与后面的句子合并
+MARKDOWN_LINK_PATTERN = re.compile(r"!?\[(.*?)\]\((.*?)\)")  # Dify 回答中的图片和文件引用
+# 回答中的链接：Markdown 引用或指向常见文件的普通链接，一次扫描按出现顺序取出
+RESPONSE_LINK_PATTERN = re.compile(
+    r"!?\[(?P<name>.*?)\]\((?P<url>.*?)\)"
+    r"|(?P<file>https?://[^\s<>\"]+?/[^\s<>\"]+?\.(?:pdf|docx|doc|xlsx|xls|txt|zip|rar|7z|tar\.gz|tar|gz)"
+    # 扩展名之后不能紧跟字母、数字或路径，避免把 .docx 截成 .doc；可以带查询参数或锚点
+    r"(?![A-Za-z0-9_/]|\.[A-Za-z0-9])(?:[?#][A-Za-z0-9._~%&=+/?#:@-]*[A-Za-z0-9_~%&=+/#@-])?)"
+)
+RESPONSE_IMAGE_EXTENSIONS = ("jpg", "jpeg", "png", "gif", "bmp", "webp")
+RESPONSE_VOICE_EXTENSIONS = ("mp3", "wav", "ogg", "m4a")
+RESPONSE_VIDEO_EXTENSIONS = ("mp4", "avi", "mov", "mkv", "flv")
 
 # 聊天室消息模板
 CHAT_JOIN_MESSAGE = """✨ 欢迎来到聊天室！让我们开始愉快的对话吧~
@@ -280,6 +321,716 @@ class ChatRoomManager:
             return "🥉"
         return f"{rank}."
 
+@dataclass
+class ResponseLink:
+    """回答中需要下载并发送的链接"""
+    url: str
+    is_file: bool  # True 为普通文件链接，False 为 Markdown 引用
+    headers: Optional[dict] = None
+
+@dataclass
+class MediaEntry:
+    """媒体缓存条目，同一份数据可以同时挂在多个键下"""
+    content: Optional[bytes] = None
+    name: str = ""
+    mime_type: str = ""
+    ttl: float = 60
+    timestamp: float = field(default_factory=time.time)
+    size: int = 0
+    loader: Optional[callable] = None  # 延迟下载时使用的加载函数
+    task: Optional[asyncio.Task] = None  # 正在进行的延迟下载任务
+    path: str = ""  # 大文件落盘后的路径，此时 content 为空且不计入内存预算
+    mapping: Optional[mmap.mmap] = None  # 落盘文件的内存映射，释放条目时关闭
+    keys: set = field(default_factory=set)
+
+class MediaCache:
+    """按字节预算管理的媒体缓存，支持 LRU + TTL 淘汰和后台清理"""
+
+    def __init__(self, max_bytes: int, sweep_interval: float = MEDIA_CACHE_SWEEP_INTERVAL):
+        self.max_bytes = max_bytes
+        self.sweep_interval = sweep_interval
+        self.total_bytes = 0
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0}
+        self._keys: Dict[tuple[str, str], MediaEntry] = {}
+        self._lru: OrderedDict[int, MediaEntry] = OrderedDict()
+        # 暂时无法删除的落盘文件：(路径, 内存映射)，后台清理时重试
+        self._pending_removals: list[tuple[str, Optional[mmap.mmap]]] = []
+        self._sweeper: Optional[asyncio.Task] = None
+
+    def put(self, namespace: str, keys: list[str], entry: MediaEntry) -> MediaEntry:
+        """将条目挂到一个或多个键下，数据只存储一份"""
+        for key in keys:
+            old_entry = self._keys.get((namespace, key))
+            if old_entry is not None and old_entry is not entry:
+                self._detach(namespace, key, old_entry)
+            self._keys[(namespace, key)] = entry
+            entry.keys.add((namespace, key))
+
+        if id(entry) not in self._lru:
+            self.total_bytes += entry.size
+        self._lru[id(entry)] = entry
+        self._lru.move_to_end(id(entry))
+        self._evict_over_budget()
+        self._ensure_sweeper()
+        return entry
+
+    def get(self, namespace: str, key: str) -> Optional[MediaEntry]:
+        """获取未过期的条目并刷新其访问时间"""
+        entry = self._keys.get((namespace, key))
+        if entry is None:
+            self.stats["misses"] += 1
+            return None
+        if time.time() - entry.timestamp > entry.ttl:
+            self.stats["expirations"] += 1
+            self.stats["misses"] += 1
+            self._drop(entry)
+            return None
+        self.stats["hits"] += 1
+        entry.timestamp = time.time()
+        self._lru.move_to_end(id(entry))
+        return entry
+
+    def peek(self, namespace: str, key: str) -> Optional[MediaEntry]:
+        """查看键当前对应的条目，不检查过期也不刷新访问时间"""
+        return self._keys.get((namespace, key))
+
+    def remove(self, namespace: str, key: str) -> None:
+        """移除一个键，条目不再被任何键引用时释放数据"""
+        entry = self._keys.get((namespace, key))
+        if entry is not None:
+            self._detach(namespace, key, entry)
+
+    def discard(self, entry: MediaEntry) -> None:
+        """从所有键下移除条目并释放数据"""
+        self._drop(entry)
+
+    def update_size(self, entry: MediaEntry, size: int) -> None:
+        """更新条目大小（延迟下载完成后调用）"""
+        if id(entry) in self._lru:
+            self.total_bytes += size - entry.size
+        entry.size = size
+        self._evict_over_budget()
+
+    def sweep(self) -> None:
+        """清理过期条目并按 LRU 淘汰超出预算的条目"""
+        now = time.time()
+        for entry in list(self._lru.values()):
+            if now - entry.timestamp > entry.ttl:
+                self.stats["expirations"] += 1
+                self._drop(entry)
+        self._evict_over_budget()
+        self._pending_removals = [item for item in self._pending_removals if not self._remove_file(*item)]
+
+    def _evict_over_budget(self) -> None:
+        # 未下载的元数据和落盘文件不计入内存预算，淘汰它们腾不出空间，只淘汰占用内存的条目
+        for entry in list(self._lru.values()):
+            if self.total_bytes <= self.max_bytes:
+                break
+            if entry.size <= 0:
+                continue
+            logger.debug(f"媒体缓存超出预算，淘汰条目: {entry.name or sorted(entry.keys)}, 大小: {entry.size} 字节")
+            self.stats["evictions"] += 1
+            self._drop(entry)
+
+    def _detach(self, namespace: str, key: str, entry: MediaEntry) -> None:
+        self._keys.pop((namespace, key), None)
+        entry.keys.discard((namespace, key))
+        if not entry.keys:
+            self._release(entry)
+
+    def _drop(self, entry: MediaEntry) -> None:
+        for cache_key in list(entry.keys):
+            self._keys.pop(cache_key, None)
+        entry.keys.clear()
+        self._release(entry)
+
+    def _release(self, entry: MediaEntry) -> None:
+        if self._lru.pop(id(entry), None) is not None:
+            self.total_bytes -= entry.size
+            if entry.path and not self._remove_file(entry.path, entry.mapping):
+                self._pending_removals.append((entry.path, entry.mapping))
+            entry.mapping = None
+
+    @staticmethod
+    def _remove_file(path: str, mapping: Optional[mmap.mmap]) -> bool:
+        """关闭内存映射并删除落盘文件，仍在使用时返回 False 稍后重试"""
+        # Windows 上文件被映射时无法删除，必须先关闭映射
+        if mapping is not None and not mapping.closed:
+            try:
+                mapping.close()
+            except BufferError:
+                logger.debug(f"落盘缓存文件仍在使用，稍后删除: {path}")
+                return False
+        try:
+            os.remove(path)
+            logger.debug(f"已删除落盘缓存文件: {path}")
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning(f"删除落盘缓存文件失败，稍后重试: {e}")
+            return False
+        return True
+
+    def close(self) -> None:
+        """停止后台清理任务"""
+        if self._sweeper is not None and not self._sweeper.done():
+            self._sweeper.cancel()
+        self._sweeper = None
+        self._pending_removals = [item for item in self._pending_removals if not self._remove_file(*item)]
+
+    def _ensure_sweeper(self) -> None:
+        if self._sweeper is not None and not self._sweeper.done():
+            return
+        try:
+            self._sweeper = asyncio.get_running_loop().create_task(self._sweep_loop())
+        except RuntimeError:
+            # 没有运行中的事件循环时只依赖读取和写入时的淘汰
+            self._sweeper = None
+
+    async def _sweep_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            try:
+                self.sweep()
+                logger.debug(f"媒体缓存: {len(self._lru)} 个条目, {self.total_bytes} 字节, 统计: {self.stats}")
+            except Exception as e:
+                logger.error(f"媒体缓存清理失败: {e}")
+
+class AttachmentDownloader:
+    """通过 /Tools/DownloadFile 并发分段下载附件
+
+    所有分段共用一个连接池，按有限窗口并发请求，按偏移写入预分配的缓冲区；
+    单个分段失败时只重试该分段，并在多个API端点之间切换。
+    分段大小按端点自适应：延迟平稳时增大，出错或延迟明显升高时减小。
+    """
+
+    def __init__(self, concurrency: int = 8, min_section_size: int = DOWNLOAD_SECTION_SIZE,
+                 max_section_size: int = 16 * DOWNLOAD_SECTION_SIZE):
+        self.concurrency = max(1, concurrency)
+        self.min_section_size = min_section_size
+        self.max_section_size = max(min_section_size, max_section_size)
+        # 每个端点当前最佳的分段大小和平均延迟：url -> {"size", "latency"}
+        self.endpoint_stats: Dict[str, dict] = {}
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=60),
+                connector=aiohttp.TCPConnector(limit=self.concurrency)
+            )
+        return self._session
+
+    async def close(self) -> None:
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+    def section_size(self, url: str) -> int:
+        """获取端点当前的分段大小"""
+        return self.endpoint_stats.get(url, {}).get("size", self.min_section_size)
+
+    def _record_section(self, url: str, size: int, latency: Optional[float]) -> None:
+        """根据分段请求结果调整端点的分段大小，latency 为 None 表示失败或超时"""
+        stats = self.endpoint_stats.setdefault(url, {"size": self.min_section_size, "latency": None})
+        if latency is None:
+            stats["size"] = max(self.min_section_size, stats["size"] // 2)
+            logger.debug(f"端点 {url} 请求失败，分段大小减小到 {stats['size']} 字节")
+            return
+        if size < stats["size"]:
+            # 文件末尾的短分段不参与调整
+            return
+
+        baseline = stats["latency"]
+        if baseline is None or latency <= baseline * 1.5:
+            stats["size"] = min(stats.get("cap", self.max_section_size), stats["size"] * 2)
+        elif latency > baseline * 3:
+            stats["size"] = max(self.min_section_size, stats["size"] // 2)
+        stats["latency"] = latency if baseline is None else baseline * 0.7 + latency * 0.3
+
+    async def download(self, urls: list[str], wxid: str, attach_id: str, total_len: int, app_id: str = "") -> Optional[memoryview]:
+        """下载完整附件，任一分段最终失败时返回 None"""
+        if total_len <= 0:
+            logger.warning(f"附件大小未知，无法分段下载: AttachId={attach_id}")
+            return None
+
+        # 按 totallen 预分配缓冲区，各分段解码后直接写入对应偏移
+        buffer = bytearray(total_len)
+        view = memoryview(buffer)
+        # 优先使用最近成功的端点
+        endpoints = list(urls)
+        next_offset = 0
+        section_count = 0
+        failed = False
+        start_time = time.time()
+        logger.info(f"开始并发分段下载附件: AttachId={attach_id}, 总大小: {total_len} 字节, "
+                    f"初始分段大小: {self.section_size(endpoints[0])} 字节, 并发数: {self.concurrency}")
+
+        async def worker() -> None:
+            # 每个工作协程按当前的分段大小领取下一段，分段大小在下载过程中持续调整
+            nonlocal next_offset, section_count, failed
+            while not failed and next_offset < total_len:
+                start = next_offset
+                size = min(self.section_size(endpoints[0]), total_len - start)
+                next_offset += size
+                section_count += 1
+                if not await self._fetch_section(endpoints, view, wxid, attach_id, total_len, app_id, start, size):
+                    failed = True
+
+        worker_count = min(self.concurrency, (total_len + self.min_section_size - 1) // self.min_section_size)
+        await asyncio.gather(*(worker() for _ in range(worker_count)))
+        if failed:
+            logger.error(f"附件下载失败: AttachId={attach_id}")
+            return None
+
+        elapsed = max(time.time() - start_time, 1e-6)
+        logger.info(f"附件下载完成: AttachId={attach_id}, 大小: {total_len} 字节, 共 {section_count} 段, "
+                    f"耗时 {elapsed:.2f} 秒, 速率 {total_len / 1024 / 1024 / elapsed:.2f} MB/s, "
+                    f"当前分段大小: {self.section_size(endpoints[0])} 字节")
+        # 以只读视图交给缓存和上传，不再复制整个文件
+        return view.toreadonly()
+
+    async def _fetch_section(self, endpoints: list[str], buffer: memoryview, wxid: str, attach_id: str, total_len: int,
+                             app_id: str, start: int, size: int) -> bool:
+        """下载一个分段并写入缓冲区，服务端返回不足时继续请求剩余部分"""
+        received = 0
+        for attempt in range(DOWNLOAD_SECTION_RETRIES):
+            for url in list(endpoints):
+                while received < size:
+                    chunk = await self._request_section(url, wxid, attach_id, total_len, app_id,
+                                                        start + received, size - received)
+                    if not chunk:
+                        break
+                    chunk = memoryview(chunk)[:size - received]
+                    buffer[start + received:start + received + len(chunk)] = chunk
+                    received += len(chunk)
+                if received >= size:
+                    if endpoints[0] != url:
+                        endpoints.remove(url)
+                        endpoints.insert(0, url)
+                    return True
+                logger.warning(f"分段下载失败，切换端点: 起始位置 {start + received}, 端点 {url}, 第 {attempt + 1} 轮")
+            await asyncio.sleep(0.5 * (attempt + 1))
+        logger.error(f"分段下载最终失败: 起始位置 {start}, 大小 {size}")
+        return False
+
+    async def _request_section(self, url: str, wxid: str, attach_id: str, total_len: int, app_id: str,
+                               start: int, size: int) -> Optional[bytes]:
+        json_param = {
+            "AppID": app_id,
+            "AttachId": attach_id,
+            "DataLen": total_len,
+            "Section": {
+                "DataLen": size,
+                "StartPos": start
+            },
+            "UserName": "",  # 可选参数
+            "Wxid": wxid
+        }
+        request_start = time.time()
+        try:
+            async with self._get_session().post(url, json=json_param) as resp:
+                if resp.status != 200:
+                    logger.warning(f"API请求失败: {resp.status}")
+                    self._record_section(url, size, None)
+                    return None
+                resp_json = await resp.json(content_type=None)
+        except Exception as e:
+            logger.warning(f"请求分段时出错: {e}")
+            self._record_section(url, size, None)
+            return None
+
+        chunk = self._decode_section(resp_json.get("Data")) if resp_json.get("Success") else None
+        if not chunk:
+            logger.warning(f"API返回错误: {resp_json.get('Message', 'Unknown error')}")
+            self._record_section(url, size, None)
+            return None
+        if len(chunk) < size and start + len(chunk) < total_len:
+            # 服务端单次返回的数据有上限，之后的分段不再超过该值
+            stats = self.endpoint_stats.setdefault(url, {"size": self.min_section_size, "latency": None})
+            stats["cap"] = max(self.min_section_size, len(chunk))
+            stats["size"] = min(stats["size"], stats["cap"])
+            logger.debug(f"端点 {url} 单次最多返回 {len(chunk)} 字节，限制分段大小")
+            return chunk
+        self._record_section(url, size, time.time() - request_start)
+        return chunk
+
+    @staticmethod
+    def _decode_section(data) -> Optional[bytes]:
+        """从不同格式的响应中解析分段数据"""
+        try:
+            if isinstance(data, dict):
+                if "buffer" in data:
+                    return base64.b64decode(data["buffer"])
+                if isinstance(data.get("data"), dict) and "buffer" in data["data"]:
+                    return base64.b64decode(data["data"]["buffer"])
+            elif isinstance(data, str):
+                return base64.b64decode(data)
+        except Exception as e:
+            logger.error(f"分段数据Base64解码失败: {e}")
+            return None
+        logger.error(f"无法解析分段数据: {str(data)[:100]}")
+        return None
+
+@dataclass(order=True)
+class TranscriptionJob:
+    """排队中的语音转写任务，按优先级和提交顺序出队"""
+    priority: int
+    seq: int
+    voice_data: bytes = field(compare=False)
+    user_wxid: str = field(compare=False)
+    future: asyncio.Future = field(compare=False)
+    enqueued_at: float = field(compare=False, default_factory=time.time)
+
+class TranscriptionService:
+    """有界的语音转写工作池
+
+    固定数量的工作协程从优先级队列中取任务，同时进行的 ffmpeg 和语音识别不超过工作协程数；
+    队列满时立即拒绝新任务，避免语音突发拖慢整个机器人。
+    """
+
+    PRIORITY_ADMIN = 0
+    PRIORITY_PRIVATE = 1
+    PRIORITY_GROUP = 2
+
+    def __init__(self, transcribe, workers: int = 2, max_queue: int = 20):
+        # transcribe(voice_data, user_wxid) -> str，执行实际的转码和识别
+        self.transcribe = transcribe
+        self.workers = max(1, workers)
+        self.max_queue = max(1, max_queue)
+        self._queue: Optional[asyncio.PriorityQueue] = None
+        self._workers: list[asyncio.Task] = []
+        self._seq = 0
+        self.stats = {"submitted": 0, "rejected": 0, "completed": 0, "failed": 0,
+                      "wait_time": 0.0, "process_time": 0.0}
+
+    def submit(self, voice_data: bytes, user_wxid: str, priority: int) -> Optional[asyncio.Future]:
+        """提交转写任务，队列已满时返回 None"""
+        self._ensure_workers()
+        if self._queue.qsize() >= self.max_queue:
+            self.stats["rejected"] += 1
+            logger.warning(f"语音转写队列已满（{self.max_queue}），拒绝用户 {user_wxid} 的语音")
+            return None
+
+        self._seq += 1
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait(TranscriptionJob(priority, self._seq, voice_data, user_wxid, future))
+        self.stats["submitted"] += 1
+        logger.debug(f"语音转写任务入队: 用户 {user_wxid}, 优先级 {priority}, 队列长度 {self._queue.qsize()}")
+        return future
+
+    def close(self) -> None:
+        """停止工作协程，取消仍在排队的任务"""
+        for task in self._workers:
+            task.cancel()
+        self._workers = []
+        if self._queue is not None:
+            while not self._queue.empty():
+                job = self._queue.get_nowait()
+                job.future.cancel()
+            self._queue = None
+
+    def _ensure_workers(self) -> None:
+        if self._queue is None:
+            self._queue = asyncio.PriorityQueue()
+        self._workers = [task for task in self._workers if not task.done()]
+        while len(self._workers) < self.workers:
+            self._workers.append(asyncio.create_task(self._worker()))
+
+    async def _worker(self) -> None:
+        while True:
+            job = await self._queue.get()
+            try:
+                # 等待方已经取消的任务直接丢弃
+                if job.future.done():
+                    continue
+                wait_time = time.time() - job.enqueued_at
+                start_time = time.time()
+                try:
+                    text = await self.transcribe(job.voice_data, job.user_wxid)
+                except Exception as e:
+                    self.stats["failed"] += 1
+                    logger.error(f"语音转写失败: {e}")
+                    if not job.future.done():
+                        job.future.set_exception(e)
+                    continue
+                process_time = time.time() - start_time
+                self.stats["completed"] += 1
+                self.stats["wait_time"] += wait_time
+                self.stats["process_time"] += process_time
+                if not job.future.done():
+                    job.future.set_result(text)
+                logger.info(f"语音转写完成: 用户 {job.user_wxid}, 优先级 {job.priority}, 排队 {wait_time:.2f} 秒, "
+                            f"处理 {process_time:.2f} 秒, 剩余队列 {self._queue.qsize()}")
+            finally:
+                self._queue.task_done()
+
+class LocalSpeechRecognizer:
+    """本地语音识别引擎，在独立线程池中运行
+
+    engine 可选 google（speech_recognition 在线识别）、faster-whisper 或 vosk；
+    离线模型只在第一次使用时加载一次，之后所有识别共用，加载失败时回退到 google。
+    """
+
+    ENGINES = ("google", "faster-whisper", "vosk")
+
+    def __init__(self, engine: str = "google", model: str = "", workers: int = 1):
+        if engine not in self.ENGINES:
+            logger.warning(f"未知的本地语音识别引擎 {engine}，使用 google")
+            engine = "google"
+        self.engine = engine
+        self.model_name = model
+        self._model = None
+        self._load_lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="dify-stt")
+
+    async def recognize(self, pcm_data: bytes) -> str:
+        """识别 16kHz 单声道 16 位 PCM，失败时返回空字符串"""
+        start_time = time.time()
+        try:
+            text = await asyncio.get_running_loop().run_in_executor(self._executor, self._recognize, pcm_data)
+        except Exception as e:
+            logger.error(f"本地语音识别失败 ({self.engine}): {e}")
+            return ""
+        logger.info(f"语音转文字结果 ({self.engine}, 耗时 {time.time() - start_time:.2f} 秒): {text}")
+        return text
+
+    def close(self) -> None:
+        """关闭识别线程池，未开始的识别任务直接取消"""
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _recognize(self, pcm_data: bytes) -> str:
+        self._ensure_model()
+        if self.engine == "faster-whisper":
+            import numpy as np
+            audio = np.frombuffer(pcm_data, dtype=np.int16).astype(np.float32) / 32768.0
+            segments, _ = self._model.transcribe(audio, language="zh")
+            return "".join(segment.text for segment in segments).strip()
+        if self.engine == "vosk":
+            from vosk import KaldiRecognizer
+            recognizer = KaldiRecognizer(self._model, VOICE_SAMPLE_RATE)
+            recognizer.AcceptWaveform(pcm_data)
+            # vosk 的中文结果以空格分隔每个词
+            return json.loads(recognizer.FinalResult()).get("text", "").replace(" ", "")
+
+        audio = sr.AudioData(pcm_data, VOICE_SAMPLE_RATE, VOICE_SAMPLE_WIDTH)
+        return sr.Recognizer().recognize_google(audio, language="zh-CN")
+
+    def _ensure_model(self) -> None:
+        if self.engine == "google" or self._model is not None:
+            return
+        with self._load_lock:
+            # 等锁期间其他线程可能已加载完成，或加载失败回退到了 google
+            if self.engine == "google" or self._model is not None:
+                return
+            start_time = time.time()
+            # 离线引擎依赖较重，只在启用时导入
+            try:
+                if self.engine == "faster-whisper":
+                    from faster_whisper import WhisperModel
+                    self._model = WhisperModel(self.model_name or "small", device="cpu", compute_type="int8")
+                else:
+                    from vosk import Model
+                    self._model = Model(self.model_name) if self.model_name else Model(lang="cn")
+            except Exception as e:
+                logger.error(f"加载本地语音识别模型失败 ({self.engine})，回退到 google: {e}")
+                self.engine = "google"
+                return
+            logger.info(f"本地语音识别模型已加载 ({self.engine}): {self.model_name or '默认模型'}，"
+                        f"耗时 {time.time() - start_time:.2f} 秒")
+
+class SentenceSplitter:
+    """把逐步到达的文本按句子切分为适合语音合成的分段
+
+    每个分段至少 min_chars 个字符、至多 max_chars 个字符；
+    没有句末标点的长句在逗号等处切开，仍然过长时直接截断。
+    """
+
+    def __init__(self, max_chars: int = 200, min_chars: int = TTS_SEGMENT_MIN_CHARS):
+        self.max_chars = max(min_chars + 1, max_chars)
+        self.min_chars = min_chars
+        self.buffer = ""
+
+    def push(self, text: str) -> list[str]:
+        """追加文本，返回已经完整的分段"""
+        self.buffer += text
+        segments = []
+        while (cut := self._find_cut()) is not None:
+            segment = self.buffer[:cut].strip()
+            self.buffer = self.buffer[cut:]
+            if segment:
+                segments.append(segment)
+        return segments
+
+    def flush(self) -> list[str]:
+        """文本结束时取出剩余内容"""
+        segments = self.push("")
+        if self.buffer.strip():
+            segments.append(self.buffer.strip())
+        self.buffer = ""
+        return segments
+
+    def _find_cut(self) -> Optional[int]:
+        for match in TTS_SENTENCE_END_PATTERN.finditer(self.buffer):
+            if match.end() > self.max_chars:
+                break
+            # 句末标点可能还没有全部到达，留到下一段文本再判断
+            if match.end() >= self.min_chars and match.end() < len(self.buffer):
+                return match.end()
+        if len(self.buffer) > self.max_chars:
+            soft_break = max(self.buffer.rfind(char, 0, self.max_chars) for char in TTS_SOFT_BREAKS)
+            return soft_break + 1 if soft_break >= self.min_chars else self.max_chars
+        return None
+
+class SpeechPipeline:
+    """分段语音合成流水线
+
+    每个分段提交后立即开始合成（并发数由 synthesize 自行限制），
+    发送协程严格按提交顺序等待并发送，前面的分段合成完就先发出去；
+    合成失败的分段改为发送文字。
+    """
+
+    def __init__(self, synthesize, send_voice, send_text):
+        self.synthesize = synthesize  # async (text) -> Optional[bytes]
+        self.send_voice = send_voice  # async (audio) -> None
+        self.send_text = send_text  # async (text) -> None
+        self.start_time = time.time()
+        self.first_audio_time: Optional[float] = None
+        self.segment_count = 0
+        self.sent_count = 0  # 已经开始发送给用户的分段数，取消时正在发送的分段也计入
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._pending: list[asyncio.Task] = []
+        self._sender = asyncio.create_task(self._send_loop())
+
+    def feed(self, segment: str) -> None:
+        task = asyncio.create_task(self.synthesize(segment))
+        self._pending.append(task)
+        self._queue.put_nowait((segment, task))
+        self.segment_count += 1
+
+    async def finish(self) -> None:
+        """等待所有分段发送完成"""
+        self._queue.put_nowait(None)
+        try:
+            await self._sender
+        finally:
+            self.cancel()
+        if self.first_audio_time is not None:
+            logger.info(f"分段语音发送完成: 共 {self.segment_count} 段, 首段语音耗时 {self.first_audio_time:.2f} 秒, "
+                        f"总耗时 {time.time() - self.start_time:.2f} 秒")
+
+    def cancel(self) -> None:
+        for task in self._pending:
+            task.cancel()
+        if not self._sender.done():
+            self._sender.cancel()
+
+    async def _send_loop(self) -> None:
+        while (item := await self._queue.get()) is not None:
+            segment, task = item
+            try:
+                audio = await task
+            except Exception as e:
+                logger.error(f"语音分段合成失败: {e}")
+                audio = None
+            # 发送开始前计数，取消发生在发送途中时该分段也视为已发出
+            self.sent_count += 1
+            try:
+                if audio:
+                    await self.send_voice(audio)
+                    if self.first_audio_time is None:
+                        self.first_audio_time = time.time() - self.start_time
+                else:
+                    await self.send_text(segment)
+            except Exception as e:
+                logger.error(f"发送语音分段失败: {e}")
+
+class StreamSideEffects:
+    """在后台按顺序执行流式回答中的附带操作（发送图片、错误提示等）
+
+    接收流式回答的循环只负责提交，不等待这些操作完成，流可以全速读取；
+    操作之间保持提交顺序，回答文字发送前通过 drain 等待全部完成。
+    """
+
+    def __init__(self):
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._worker: Optional[asyncio.Task] = None
+        self.count = 0
+
+    def submit(self, action) -> None:
+        """提交一个无参数的异步函数"""
+        if self._worker is None:
+            self._worker = asyncio.create_task(self._run())
+        self._queue.put_nowait(action)
+        self.count += 1
+
+    async def drain(self) -> None:
+        if self._worker is None:
+            return
+        start_time = time.time()
+        self._queue.put_nowait(None)
+        await self._worker
+        logger.debug(f"流式附带操作全部完成: 共 {self.count} 个, 等待 {time.time() - start_time:.2f} 秒")
+
+    def cancel(self) -> None:
+        if self._worker is not None and not self._worker.done():
+            self._worker.cancel()
+
+    async def _run(self) -> None:
+        while (action := await self._queue.get()) is not None:
+            try:
+                await action()
+            except Exception as e:
+                logger.error(f"流式附带操作执行失败: {e}")
+                logger.error(traceback.format_exc())
+
+class StreamingSpeech:
+    """边接收流式回答边合成语音
+
+    message 事件的增量文本中已完整的句子立即送入合成流水线；
+    图片和文件引用不朗读，未闭合的引用先保留，等后续文本补全后再删除。
+    """
+
+    MAX_PENDING_CHARS = 1000  # 引用一直不闭合时放弃等待
+
+    def __init__(self, pipeline: SpeechPipeline, max_chars: int):
+        self.pipeline = pipeline
+        self.splitter = SentenceSplitter(max_chars)
+        self.pending = ""
+
+    def feed(self, delta: str) -> None:
+        self.pending += delta
+        start = self.pending.rfind("[")
+        if start > 0 and self.pending[start - 1] == "!":
+            # 图片引用 ![...](...) 的感叹号和引用一起保留，不单独朗读
+            start -= 1
+        if start >= 0 and self._maybe_open_link(self.pending[start:]):
+            text, self.pending = self.pending[:start], self.pending[start:]
+        elif self.pending.endswith("!"):
+            # 结尾的感叹号可能是下一段图片引用的开头
+            text, self.pending = self.pending[:-1], "!"
+        else:
+            text, self.pending = self.pending, ""
+        for segment in self.splitter.push(MARKDOWN_LINK_PATTERN.sub("", text)):
+            self.pipeline.feed(segment)
+
+    def _maybe_open_link(self, text: str) -> bool:
+        """判断以 [ 或 ![ 开头的文本是否可能是尚未接收完整的引用"""
+        if MARKDOWN_LINK_PATTERN.match(text) or len(text) >= self.MAX_PENDING_CHARS:
+            return False
+        close = text.find("]")
+        # ] 后面不是 ( 说明只是普通的方括号
+        return close < 0 or close + 1 >= len(text) or text[close + 1] == "("
+
+    async def finish(self) -> None:
+        """回答结束，合成剩余文本并等待全部发送"""
+        for segment in self.splitter.push(MARKDOWN_LINK_PATTERN.sub("", self.pending)) + self.splitter.flush():
+            self.pipeline.feed(segment)
+        self.pending = ""
+        await self.pipeline.finish()
+
+    def cancel(self) -> None:
+        self.pipeline.cancel()
+
 @dataclass
 class ModelConfig:
     api_key: str
@@ -322,6 +1073,34 @@ class Dify(PluginBase):
             # 移除单独的 URL 配置，改为动态构建
             self.remember_user_model = plugin_config.get("remember_user_model", True)
             self.chatroom_enable = plugin_config.get("chatroom_enable", True)  # 添加聊天室功能开关
+            # 图片获取方式：auto - 优先下载满足尺寸要求的CDN中图/缩略图；original - 总是下载原图
+            self.image_download_mode = plugin_config.get("image_download_mode", "auto")
+            self.image_min_dimension = plugin_config.get("image_min_dimension", IMAGE_MAX_DIMENSION)  # CDN图片可接受的最小长边，默认与上传Dify的尺寸上限一致
+            self.image_lazy_download = plugin_config.get("image_lazy_download", True)  # 收到图片时只记录元数据，使用时再下载
+            self.image_preupload = plugin_config.get("image_preupload", False)  # 私聊图片收到后立即在后台上传到Dify
+            self.media_cache_max_mb = plugin_config.get("media_cache_max_mb", 200)  # 图片和文件缓存的总内存预算（MB）
+            self.file_spill_threshold_mb = plugin_config.get("file_spill_threshold_mb", 8)  # 超过该大小的文件缓存写入磁盘
+            self.download_concurrency = plugin_config.get("download_concurrency", 8)  # 附件分段下载的并发数
+            self.file_lazy_download = plugin_config.get("file_lazy_download", False)  # 收到文件时只记录附件信息，使用时再下载
+            self.transcription_workers = plugin_config.get("transcription_workers", 2)  # 同时进行的语音转写数
+            self.transcription_queue_size = plugin_config.get("transcription_queue_size", 20)  # 语音转写排队上限
+            # 本地语音识别：google、faster-whisper 或 vosk，local_stt_primary 为 true 时优先于 Dify 接口
+            self.local_stt_engine = plugin_config.get("local_stt_engine", "google")
+            self.local_stt_model = plugin_config.get("local_stt_model", "")
+            self.local_stt_primary = plugin_config.get("local_stt_primary", False)
+            self.local_stt_workers = plugin_config.get("local_stt_workers", 1)
+            self.tts_segment_max_chars = plugin_config.get("tts_segment_max_chars", 200)  # 每段语音合成的最大字符数
+            self.tts_concurrency = plugin_config.get("tts_concurrency", 3)  # 同时进行的语音合成请求数
+            self.media_fetch_concurrency = plugin_config.get("media_fetch_concurrency", 4)  # 回答中链接的并发下载数
+            self.media_fetch_max_mb = plugin_config.get("media_fetch_max_mb", 20)  # 回答中单个链接的下载大小上限（MB）
+            self.tts_stream_synthesis = plugin_config.get("tts_stream_synthesis", False)  # 语音回复边生成边合成
+            self.tts_cache_max_mb = plugin_config.get("tts_cache_max_mb", 50)  # 语音合成结果磁盘缓存上限（MB）
+            self.tts_cache_ttl = plugin_config.get("tts_cache_ttl", 7 * 24 * 3600)  # 语音合成结果缓存时间（秒）
+            self.transcript_cache_ttl = plugin_config.get("transcript_cache_ttl", 3600)  # 语音转写结果缓存时间（秒）
+            self.transcript_cache_max_kb = plugin_config.get("transcript_cache_max_kb", 512)  # 语音转写结果缓存上限（KB）
+            # 附件分段大小的自适应范围（KB）
+            self.download_section_min_kb = plugin_config.get("download_section_min_kb", 64)
+            self.download_section_max_kb = plugin_config.get("download_section_max_kb", 1024)
 
             # 加载所有模型配置
             self.models = {}
@@ -342,15 +1121,50 @@ class Dify(PluginBase):
             raise
 
         self.db = XYBotDB()
-        self.image_cache = {}
+        # 图片和文件共用一个按字节预算管理的媒体缓存
+        self.media_cache = MediaCache(self.media_cache_max_mb * 1024 * 1024)
         self.image_cache_timeout = 60
-        # 添加文件缓存
-        self.file_cache = {}
+        # 私聊图片预上传任务：聊天对象ID -> {"model", "task", "timestamp"}
+        self.image_upload_tasks = {}
         self.file_cache_timeout = 300  # 5分钟文件缓存超时
+        # 附件分段下载器，所有下载共用一个连接池
+        # 进行中的附件下载任务：去重键 -> Task
+        self.attachment_downloads: Dict[str, asyncio.Task] = {}
+        self.attachment_downloader = AttachmentDownloader(
+            self.download_concurrency,
+            min_section_size=self.download_section_min_kb * 1024,
+            max_section_size=self.download_section_max_kb * 1024
+        )
+        # 语音转写工作池，管理员和私聊优先
+        self.transcription_service = TranscriptionService(
+            self._transcribe_voice,
+            workers=self.transcription_workers,
+            max_queue=self.transcription_queue_size
+        )
+        self.local_recognizer = LocalSpeechRecognizer(self.local_stt_engine, self.local_stt_model, self.local_stt_workers)
+        # 所有语音回复共用的合成并发限制
+        self.tts_semaphore = asyncio.Semaphore(max(1, self.tts_concurrency))
+        # 回复中图片和文件的下载共用一个连接池
+        self._media_session: Optional[aiohttp.ClientSession] = None
+        self.media_fetch_semaphore = asyncio.Semaphore(max(1, self.media_fetch_concurrency))
+        # 语音转写结果缓存：模型地址 + 语音数据哈希 -> 文本，独立预算不与图片文件互相挤占
+        self.transcript_cache = MediaCache(self.transcript_cache_max_kb * 1024)
         # 添加文件存储目录配置
         self.files_dir = "files"
         # 创建文件存储目录
         os.makedirs(self.files_dir, exist_ok=True)
+        # 清理上次运行遗留的落盘缓存文件
+        for leftover in os.listdir(self.files_dir):
+            if leftover.startswith(SPILL_FILE_PREFIX):
+                try:
+                    os.remove(os.path.join(self.files_dir, leftover))
+                except OSError as e:
+                    logger.warning(f"清理遗留缓存文件失败: {e}")
+        # 语音合成结果的磁盘缓存，按总大小做 LRU 淘汰，重启后继续使用
+        self.tts_cache_dir = os.path.join(self.files_dir, "tts_cache")
+        os.makedirs(self.tts_cache_dir, exist_ok=True)
+        self.tts_cache = MediaCache(self.tts_cache_max_mb * 1024 * 1024)
+        self._load_tts_cache()
 
         # 创建唤醒词到模型的映射
         self.wakeup_word_to_model = {}
@@ -389,6 +1203,24 @@ class Dify(PluginBase):
                 logger.error(f"获取API代理实例失败: {e}")
                 logger.error(traceback.format_exc())
 
+    async def on_disable(self):
+        """插件禁用或重载时关闭连接池、后台任务和线程池"""
+        await super().on_disable()
+        for task in list(self.attachment_downloads.values()):
+            task.cancel()
+        self.attachment_downloads.clear()
+        for preupload in self.image_upload_tasks.values():
+            preupload["task"].cancel()
+        self.image_upload_tasks.clear()
+        self.transcription_service.close()
+        self.local_recognizer.close()
+        for cache in (self.media_cache, self.transcript_cache, self.tts_cache):
+            cache.close()
+        await self.attachment_downloader.close()
+        if self._media_session is not None and not self._media_session.closed:
+            await self._media_session.close()
+        logger.info("Dify插件已释放连接池和后台任务")
+
     def get_user_model(self, user_id: str) -> ModelConfig:
         """获取用户当前使用的模型"""
         if self.remember_user_model and user_id in self.user_models:
@@ -489,6 +1321,8 @@ class Dify(PluginBase):
                 try:
                     # 检查是否有唤醒词或触发词
                     model, processed_query, is_switch = self.get_model_from_message(messages, user_wxid)
+                    # 只在真正发起请求时才上传群里最近的图片
+                    files = files + await self.get_image_files(group_id, model)
                     await self.dify(bot, message, processed_query, files=files, specific_model=model)
                     logger.debug("成功调用 Dify API 并发送消息")
                 except Exception as e:
@@ -529,41 +1363,6 @@ class Dify(PluginBase):
         buffer = self.chat_manager.message_buffers[key]
         logger.debug(f"安排消息处理 - 用户: {user_wxid}, 群组: {group_id}")
 
-        # 获取buffer中的消息内容
-        buffer_content = "\n".join(buffer.messages) if buffer.messages else ""
-
-        # 检查是否有最近的图片
-        image_content = await self.get_cached_image(group_id)
-        if image_content:
-            try:
-                logger.debug("发现最近的图片，准备上传到 Dify")
-                # 先检查是否有唤醒词获取对应模型
-                wakeup_model = None
-                for wakeup_word, model_config in self.wakeup_word_to_model.items():
-                    wakeup_lower = wakeup_word.lower()
-                    buffer_content_lower = buffer_content.lower()
-                    if buffer_content_lower.startswith(wakeup_lower) or f" {wakeup_lower}" in buffer_content_lower:
-                        wakeup_model = model_config
-                        break
-
-                # 如果没有找到唤醒词对应的模型，则使用用户当前的模型
-                model_config = wakeup_model or self.get_user_model(user_wxid)
-
-                file_id = await self.upload_file_to_dify(
-                    image_content,
-                    "image/jpeg",
-                    group_id,
-                    model_config=model_config  # 传递正确的模型配置
-                )
-                if file_id:
-                    logger.debug(f"图片上传成功，文件ID: {file_id}")
-                    buffer.files.append(file_id)  # 直接添加到buffer的files列表
-                    logger.debug(f"当前buffer中的文件: {buffer.files}")
-                else:
-                    logger.error("图片上传失败")
-            except Exception as e:
-                logger.error(f"处理图片失败: {e}")
-
         if buffer.message_count >= MAX_BUFFERED_MESSAGES:
             logger.debug("缓冲区已满，立即处理消息")
             await self.process_buffered_messages(bot, group_id, user_wxid)
@@ -594,25 +1393,7 @@ class Dify(PluginBase):
             model, processed_query, is_switch = self.get_model_from_message(content, message["SenderWxid"])
 
             # 检查是否有最近的图片
-            image_content = await self.get_cached_image(message["FromWxid"])
-            files = []
-            if image_content:
-                try:
-                    logger.debug("发现最近的图片，准备上传到 Dify")
-                    file_id = await self.upload_file_to_dify(
-                        image_content,
-                        f"image_{int(time.time())}.jpg",  # 生成一个有效的文件名
-                        "image/jpeg",  # 根据实际图片类型调整
-                        message["FromWxid"],
-                        model_config=model  # 传递正确的模型配置
-                    )
-                    if file_id:
-                        logger.debug(f"图片上传成功，文件ID: {file_id}")
-                        files = [file_id]
-                    else:
-                        logger.error("图片上传失败")
-                except Exception as e:
-                    logger.error(f"处理图片失败: {e}")
+            files = await self.get_image_files(message["FromWxid"], model)
 
             if command in self.commands:
                 query = content[len(command):].strip()
@@ -696,34 +1477,12 @@ class Dify(PluginBase):
                     logger.info(f"处理后的查询内容: '{processed_wakeup_query}'")
                 break
 
-        # 检查是否有最近的图片 - 无论聊天室功能是否启用都获取图片
-        files = []
-        image_content = await self.get_cached_image(group_id)
-        if image_content:
-            try:
-                logger.debug("发现最近的图片，准备上传到 Dify")
-                # 如果检测到唤醒词，使用对应模型；否则使用用户当前模型
-                model_config = wakeup_model or self.get_user_model(user_wxid)
-
-                file_id = await self.upload_file_to_dify(
-                    image_content,
-                    "image/jpeg",
-                    group_id,
-                    model_config=model_config  # 传递正确的模型配置
-                )
-                if file_id:
-                    logger.debug(f"图片上传成功，文件ID: {file_id}")
-                    files = [file_id]
-                else:
-                    logger.error("图片上传失败")
-            except Exception as e:
-                logger.error(f"处理图片失败: {e}")
-
         # 如果检测到唤醒词，处理唤醒词请求
         if wakeup_detected and wakeup_model and processed_wakeup_query:
             if wakeup_model.api_key:  # 检查唤醒词对应模型的API密钥
                 if await self._check_point(bot, message, wakeup_model):  # 传递模型到_check_point
                     logger.info(f"使用唤醒词对应模型处理请求")
+                    files = await self.get_image_files(group_id, wakeup_model)
                     await self.dify(bot, message, processed_wakeup_query, files=files, specific_model=wakeup_model)
                     return
                 else:
@@ -750,9 +1509,10 @@ class Dify(PluginBase):
                     if command in self.commands:
                         query = query[len(command):].strip()
                     if query:
+                        # 检查是否有唤醒词或触发词
+                        model, processed_query, is_switch = self.get_model_from_message(query, message["SenderWxid"])
                         if await self._check_point(bot, message, model):
-                            # 检查是否有唤醒词或触发词
-                            model, processed_query, is_switch = self.get_model_from_message(query, message["SenderWxid"])
+                            files = [] if is_switch else await self.get_image_files(group_id, model)
                             await self.dify(bot, message, processed_query, files=files, specific_model=model)
             return
 
@@ -766,6 +1526,8 @@ class Dify(PluginBase):
                     query = query[len(command):].strip()
                 if query:
                     if await self._check_point(bot, message):
+                        model, _, is_switch = self.get_model_from_message(query, user_wxid)
+                        files = [] if is_switch else await self.get_image_files(group_id, model)
                         await self.dify(bot, message, query, files=files)
             return
 
@@ -819,11 +1581,12 @@ class Dify(PluginBase):
                                 [message["SenderWxid"]]
                             )
                             return
+                        files = await self.get_image_files(group_id, model)
                         await self.dify(bot, message, processed_query, files=files, specific_model=model)
             else:
-                # 只有在聊天室功能开启时，才缓冲普通消息
+                # 只有在聊天室功能开启时，才缓冲普通消息，图片在缓冲区处理时再上传
                 if self.chatroom_enable:
-                    await self.chat_manager.add_message_to_buffer(group_id, user_wxid, content, files)
+                    await self.chat_manager.add_message_to_buffer(group_id, user_wxid, content)
                     await self.schedule_message_processing(bot, group_id, user_wxid)
         return
 
@@ -882,29 +1645,10 @@ class Dify(PluginBase):
             await bot.send_at_message(message["FromWxid"], f"\n此模型API密钥未配置，请联系管理员", [message["SenderWxid"]])
             return False
 
-        # 检查是否有最近的图片
-        files = []
-        image_content = await self.get_cached_image(group_id)
-        if image_content:
-            try:
-                logger.debug("@消息中发现最近的图片，准备上传到 Dify")
-                file_id = await self.upload_file_to_dify(
-                    image_content,
-                    "image/jpeg",
-                    group_id,
-                    model_config=model  # 传递正确的模型配置
-                )
-                if file_id:
-                    logger.debug(f"图片上传成功，文件ID: {file_id}")
-                    files = [file_id]
-                else:
-                    logger.error("图片上传失败")
-            except Exception as e:
-                logger.error(f"处理图片失败: {e}")
-
         if await self._check_point(bot, message, model):  # 传递正确的模型参数
             # 使用上面已经获取的模型和处理过的查询
             logger.info(f"@消息使用模型 '{next((name for name, config in self.models.items() if config == model), '未知')}' 处理请求")
+            files = await self.get_image_files(group_id, model)
             await self.dify(bot, message, processed_query, files=files, specific_model=model)
         else:
             logger.info(f"积分检查失败，无法处理@消息请求")
@@ -961,28 +1705,9 @@ class Dify(PluginBase):
                     await bot.send_at_message(message["FromWxid"], f"\n此模型API密钥未配置，请联系管理员", [user_wxid])
                     return False
 
-                # 检查是否有最近的图片
-                files = []
-                image_content = await self.get_cached_image(group_id)
-                if image_content:
-                    try:
-                        logger.debug("引用消息中发现最近的图片，准备上传到 Dify")
-                        file_id = await self.upload_file_to_dify(
-                            image_content,
-                            "image/jpeg",
-                            group_id,
-                            model_config=model
-                        )
-                        if file_id:
-                            logger.debug(f"图片上传成功，文件ID: {file_id}")
-                            files = [file_id]
-                        else:
-                            logger.error("图片上传失败")
-                    except Exception as e:
-                        logger.error(f"处理图片失败: {e}")
-
                 if await self._check_point(bot, message, model):
                     logger.info(f"引用消息使用模型 '{next((name for name, config in self.models.items() if config == model), '未知')}' 处理请求")
+                    files = await self.get_image_files(group_id, model)
                     await self.dify(bot, message, processed_query, files=files, specific_model=model)
                 else:
                     logger.info(f"积分检查失败，无法处理引用消息请求")
@@ -1015,24 +1740,7 @@ class Dify(PluginBase):
                 return False
 
             # 检查是否有最近的图片
-            files = []
-            image_content = await self.get_cached_image(message["FromWxid"])
-            if image_content:
-                try:
-                    logger.debug("引用消息中发现最近的图片，准备上传到 Dify")
-                    file_id = await self.upload_file_to_dify(
-                        image_content,
-                        "image/jpeg",
-                        message["FromWxid"],
-                        model_config=model
-                    )
-                    if file_id:
-                        logger.debug(f"图片上传成功，文件ID: {file_id}")
-                        files = [file_id]
-                    else:
-                        logger.error("图片上传失败")
-                except Exception as e:
-                    logger.error(f"处理图片失败: {e}")
+            files = await self.get_image_files(message["FromWxid"], model)
 
             if await self._check_point(bot, message, model):
                 logger.info(f"私聊引用消息使用模型 '{next((name for name, config in self.models.items() if config == model), '未知')}' 处理请求")
@@ -1055,6 +1763,9 @@ class Dify(PluginBase):
             return False
 
         query = await self.audio_to_text(bot, message)
+        if query is None:
+            await bot.send_text_message(message["FromWxid"], VOICE_TRANSCRIPTION_BUSY)
+            return False
         if not query:
             await bot.send_text_message(message["FromWxid"], VOICE_TRANSCRIPTION_FAILED)
             return False
@@ -1086,6 +1797,15 @@ class Dify(PluginBase):
             logger.info(f"积分检查失败，无法处理语音消息请求")
         return False
 
+    @staticmethod
+    @functools.lru_cache(maxsize=256)
+    def _parse_xml(content: str) -> ET.Element:
+        """解析XML消息，同一条消息在多个处理器之间只解析一次
+
+        返回的元素树在处理器之间共享，只能读取不能修改。
+        """
+        return ET.fromstring(content)
+
     def is_at_message(self, message: dict) -> bool:
         """检查消息是否@了机器人
 
@@ -1141,7 +1861,7 @@ class Dify(PluginBase):
             # 如果有OriginalContent，尝试解析XML
             if "OriginalContent" in message:
                 try:
-                    root = ET.fromstring(message.get("OriginalContent", ""))
+                    root = self._parse_xml(message.get("OriginalContent", ""))
                     title = root.find("appmsg/title")
                     if title is not None and title.text:
                         # 检查引用消息的标题中是否包含@机器人
@@ -1233,6 +1953,10 @@ class Dify(PluginBase):
                     "upload_file_id": file_info["id"]
                 })
 
+        speech = None  # 边生成边合成的语音回复
+        speech_interrupted = False  # 边生成边合成的语音已发出部分后回答被替换
+        side_effects = None  # 流式回答中的后台附带操作
+        prefetched: Dict[str, asyncio.Task] = {}  # 流式回答中提前开始的链接下载
         try:
             logger.debug(f"开始调用 Dify API - 用户消息: {processed_query}")
             logger.debug(f"文件列表: {formatted_files}")
@@ -1312,6 +2036,12 @@ class Dify(PluginBase):
                 async with aiohttp.ClientSession(proxy=self.http_proxy) as session:
                     async with session.post(url=f"{model.base_url}/chat-messages", headers=headers, data=json.dumps(payload)) as resp:
                         if resp.status in (200, 201):
+                            # 图片和错误提示在后台按顺序处理，不阻塞流的读取
+                            side_effects = StreamSideEffects()
+                            # 语音回复时已完整的句子立即开始合成，不等回答全部生成
+                            if self.tts_stream_synthesis and (message["MsgType"] == 34 or self.voice_reply_all):
+                                speech = StreamingSpeech(self._create_speech_pipeline(bot, message), self.tts_segment_max_chars)
+                            link_scan_position = 0
                             async for line in resp.content:
                                 line = line.decode("utf-8").strip()
                                 if not line or line == "event: ping":
@@ -1327,18 +2057,31 @@ class Dify(PluginBase):
                                 event = resp_json.get("event", "")
                                 if event == "message":
                                     ai_resp += resp_json.get("answer", "")
+                                    if speech:
+                                        speech.feed(resp_json.get("answer", ""))
+                                    link_scan_position = self._prefetch_response_links(
+                                        ai_resp, link_scan_position, model, prefetched)
                                 elif event == "message_replace":
                                     ai_resp = resp_json.get("answer", "")
+                                    link_scan_position = self._prefetch_response_links(ai_resp, 0, model, prefetched)
+                                    if speech:
+                                        logger.warning("Dify替换了回答内容，停止边生成边合成")
+                                        speech.cancel()
+                                        # 已开始发送的语音无法撤回，替换后的回答改为文字发送，避免重复朗读
+                                        speech_interrupted = speech.pipeline.sent_count > 0
+                                        speech = None
                                 elif event == "message_file":
                                     file_url = resp_json.get("url", "")
-                                    await self.dify_handle_image(bot, message, file_url, model_config=model)
+                                    side_effects.submit(functools.partial(
+                                        self.dify_handle_image, bot, message, file_url, model_config=model))
                                 elif event == "error":
-                                    await self.dify_handle_error(bot, message,
-                                                                resp_json.get("task_id", ""),
-                                                                resp_json.get("message_id", ""),
-                                                                resp_json.get("status", ""),
-                                                                resp_json.get("code", ""),
-                                                                resp_json.get("message", ""))
+                                    side_effects.submit(functools.partial(
+                                        self.dify_handle_error, bot, message,
+                                        resp_json.get("task_id", ""),
+                                        resp_json.get("message_id", ""),
+                                        resp_json.get("status", ""),
+                                        resp_json.get("code", ""),
+                                        resp_json.get("message", "")))
 
                             new_con_id = resp_json.get("conversation_id", "")
                             if new_con_id and new_con_id != conversation_id:
@@ -1357,31 +2100,102 @@ class Dify(PluginBase):
                         else:
                             return await self.handle_other_status(bot, message, resp)
 
+                # 图片等附带操作先于回答文字完成，保持原有的发送顺序
+                if side_effects:
+                    await side_effects.drain()
+                if speech:
+                    await speech.finish()
                 if ai_resp:
-                    await self.dify_handle_text(bot, message, ai_resp, model)
+                    await self.dify_handle_text(bot, message, ai_resp, model, voice_sent=speech is not None,
+                                                prefetched=prefetched, force_text=speech_interrupted)
                 else:
                     logger.warning("Dify未返回有效响应")
         except Exception as e:
             logger.error(f"Dify API 调用失败: {e}")
+            if side_effects:
+                side_effects.cancel()
+            for task in prefetched.values():
+                task.cancel()
+            if speech:
+                speech.cancel()
             await self.hendle_exceptions(bot, message, model_config=model)
 
+    def _get_media_session(self) -> aiohttp.ClientSession:
+        if self._media_session is None or self._media_session.closed:
+            self._media_session = aiohttp.ClientSession(proxy=self.http_proxy, timeout=aiohttp.ClientTimeout(total=120))
+        return self._media_session
+
+    async def _fetch_media(self, url: str, headers: Optional[dict] = None, accept_html: bool = True) -> tuple[bytes, str]:
+        """通过共享连接池下载回复中的媒体，返回 (内容, Content-Type)
+
+        HTTP 错误或超过 media_fetch_max_mb 时抛出异常；accept_html 为 False 时网页不下载正文，返回空内容。
+        """
+        max_bytes = self.media_fetch_max_mb * 1024 * 1024
+        async with self._get_media_session().get(url, headers=headers) as resp:
+            resp.raise_for_status()
+            content_type = resp.headers.get("Content-Type", "")
+            if not accept_html and content_type.startswith("text/html"):
+                logger.debug(f"链接是网页，跳过下载: {url}")
+                return b"", content_type
+            if resp.content_length and resp.content_length > max_bytes:
+                raise ValueError(f"文件大小 {resp.content_length} 字节超过限制 {max_bytes} 字节")
+            content = bytearray()
+            async for chunk in resp.content.iter_chunked(UPLOAD_CHUNK_SIZE):
+                content += chunk
+                if len(content) > max_bytes:
+                    raise ValueError(f"文件大小超过限制 {max_bytes} 字节")
+            return bytes(content), content_type
+
     async def download_file(self, url: str) -> tuple[bytes, str]:
         """
         下载文件并返回文件内容和MIME类型
         """
-        async with aiohttp.ClientSession(proxy=self.http_proxy) as session:
-            async with session.get(url) as resp:
-                content_type = resp.headers.get('Content-Type', '')
-                return await resp.read(), content_type
+        return await self._fetch_media(url)
+
+    @staticmethod
+    def _open_image_scaled(image_data: bytes, max_dimension: int = IMAGE_MAX_DIMENSION) -> tuple[Image.Image, tuple[int, int]]:
+        """打开图片并缩放到不超过 max_dimension，返回 (图片, 原始尺寸)
+
+        JPEG 使用 draft 模式在 DCT 域按 1/2、1/4、1/8 直接降采样解码，
+        再用 LANCZOS 精确缩放到目标尺寸，避免完整解码大图。
+        """
+        img = Image.open(io.BytesIO(image_data))
+        original_size = img.size
+        width, height = original_size
+        bands = len(img.getbands())
+        full_decode_bytes = width * height * bands
+
+        if width > max_dimension or height > max_dimension:
+            ratio = min(max_dimension / width, max_dimension / height)
+            target_size = (max(1, int(width * ratio)), max(1, int(height * ratio)))
+            if img.format == "JPEG":
+                # draft 保证解码尺寸不小于目标尺寸
+                img.draft(img.mode, target_size)
+            decode_bytes = img.size[0] * img.size[1] * bands
+            logger.info(f"图片尺寸过大，调整大小从 {width}x{height} 到 {target_size[0]}x{target_size[1]}，"
+                        f"解码尺寸: {img.size[0]}x{img.size[1]}")
+            img = img.resize(target_size, Image.LANCZOS)
+        else:
+            decode_bytes = full_decode_bytes
+
+        logger.debug(f"图片解码内存峰值约 {decode_bytes / 1024 / 1024:.1f} MB"
+                     f"（完整解码需 {full_decode_bytes / 1024 / 1024:.1f} MB）")
+        return img, original_size
 
-    async def upload_file_to_dify(self, file_content: bytes, file_name: str, mime_type: str, user: str, model_config=None) -> Optional[dict]:
+    async def upload_file_to_dify(self, file_content: Union[bytes, memoryview, io.IOBase, AsyncIterable[bytes]],
+                                  file_name: str, mime_type: str, user: str, model_config=None,
+                                  file_size: Optional[int] = None) -> Optional[dict]:
         """
         上传文件到Dify并返回文件信息
+        file_content 可以是字节数据、内存映射、文件对象或异步字节迭代器，非图片文件以流式方式上传
         返回格式: {"id": "uuid", "type": "image|document|audio|video"}
         """
-        logger.info(f"开始上传文件到Dify, 用户: {user}, 文件名: {file_name}, 文件大小: {len(file_content)} 字节, MIME类型: {mime_type}")
+        if isinstance(file_content, (bytes, bytearray, memoryview)):
+            file_size = len(file_content)
+        logger.info(f"开始上传文件到Dify, 用户: {user}, 文件名: {file_name}, "
+                    f"文件大小: {file_size if file_size is not None else '未知'} 字节, MIME类型: {mime_type}")
 
-        if not file_content or len(file_content) == 0:
+        if file_content is None or file_size == 0:
             logger.error("文件内容为空，无法上传")
             return None
 
@@ -1421,7 +2235,10 @@ class Dify(PluginBase):
                     logger.info(f"检测到 PPT 文件，使用 document 类型上传")
             elif file_extension in image_extensions or mime_type.startswith('image/'):
                 file_type = "image"
-                # 处理图片文件
+                # 处理图片文件，图片需要完整解码，流式来源先读入内存
+                if not isinstance(file_content, (bytes, bytearray, memoryview)):
+                    file_content = await self._read_upload_source(file_content)
+                    file_size = len(file_content)
                 try:
                     # 尝试打开图片数据
                     # 特别处理截断的图片文件
@@ -1430,8 +2247,8 @@ class Dify(PluginBase):
 
                     # 使用BytesIO确保完整读取图片数据
                     image_io = io.BytesIO(file_content)
-                    image = Image.open(image_io)
-                    logger.debug(f"原始图片格式: {image.format}, 大小: {image.size}, 模式: {image.mode}")
+                    # 打开并缩放图片，JPEG 会直接以降低的分辨率解码
+                    image, _ = self._open_image_scaled(file_content)
 
                     # 转换为RGB模式(去除alpha通道)
                     if image.mode in ('RGBA', 'LA'):
@@ -1440,20 +2257,8 @@ class Dify(PluginBase):
                         background.paste(image, mask=image.split()[-1])
                         image = background
 
-                    # 检查图片大小，如果太大则调整大小
-                    max_dimension = 1600  # 最大尺寸限制
                     max_file_size = 1024 * 1024 * 2  # 2MB大小限制
 
-                    # 调整图片尺寸
-                    width, height = image.size
-                    if width > max_dimension or height > max_dimension:
-                        # 计算缩放比例
-                        ratio = min(max_dimension / width, max_dimension / height)
-                        new_width = int(width * ratio)
-                        new_height = int(height * ratio)
-                        logger.info(f"图片尺寸过大，调整大小从 {width}x{height} 到 {new_width}x{new_height}")
-                        image = image.resize((new_width, new_height), Image.LANCZOS)
-
                     # 保存为JPEG，尝试不同的质量级别以满足大小限制
                     quality = 95
                     output = io.BytesIO()
@@ -1471,6 +2276,7 @@ class Dify(PluginBase):
                         logger.debug(f"降低图片质量到 {quality}，新大小: {len(resized_content)} 字节")
 
                     file_content = resized_content
+                    file_size = len(file_content)
                     mime_type = 'image/jpeg'
                     file_extension = 'jpg'
                     logger.info(f"图片处理成功，质量: {quality}，新大小: {len(file_content)} 字节")
@@ -1483,6 +2289,7 @@ class Dify(PluginBase):
                         logger.error(f"处理后的图片验证失败: {e}")
                         # 如果处理后的图片无效，尝试使用原始图片数据
                         file_content = image_io.getvalue()
+                        file_size = len(file_content)
                         logger.warning(f"使用原始图片数据上传，大小: {len(file_content)} 字节")
                 except Exception as e:
                     logger.error(f"图片格式转换失败: {e}")
@@ -1544,8 +2351,13 @@ class Dify(PluginBase):
             # 使用直接连接上传文件
             headers = {"Authorization": f"Bearer {model.api_key}"}
             formdata = aiohttp.FormData()
-            # 使用处理后的文件名
-            formdata.add_field("file", file_content,
+            # 内存中的数据（包括落盘文件的内存映射视图）直接交给 aiohttp，请求带 Content-Length；
+            # 文件对象和异步迭代器才分块流式发送，不在内存中拼出完整请求体
+            if isinstance(file_content, (bytes, bytearray, memoryview)):
+                file_payload = file_content
+            else:
+                file_payload = self._upload_stream(file_content, file_size, processed_file_name)
+            formdata.add_field("file", file_payload,
                             filename=processed_file_name,
                             content_type=mime_type)
             formdata.add_field("user", user)
@@ -1553,8 +2365,8 @@ class Dify(PluginBase):
             url = f"{model.base_url}/files/upload"
             logger.debug(f"开始请求Dify文件上传API: {url}")
 
-            # 设置较长的超时时间
-            timeout = aiohttp.ClientTimeout(total=60)  # 60秒超时
+            # 大文件上传耗时不定，只限制连接和单次读取的超时时间
+            timeout = aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=60)
 
             try:
                 async with aiohttp.ClientSession(proxy=self.http_proxy, timeout=timeout) as session:
@@ -1565,13 +2377,11 @@ class Dify(PluginBase):
                             if file_id:
                                 logger.info(f"文件上传成功，文件ID: {file_id}, 类型: {file_type}")
                                 # 上传成功后删除缓存
-                                if user in self.file_cache:
-                                    del self.file_cache[user]
-                                    logger.debug(f"已清除用户 {user} 的文件缓存")
+                                self.media_cache.remove("file", user)
                                 # 清除图片缓存
-                                if file_type == "image" and user in self.image_cache:
-                                    del self.image_cache[user]
-                                    logger.debug(f"已清除用户 {user} 的图片缓存")
+                                if file_type == "image":
+                                    self.media_cache.remove("image", user)
+                                logger.debug(f"已清除用户 {user} 的媒体缓存")
                                 return {
                                     "id": file_id,
                                     "type": file_type
@@ -1590,20 +2400,62 @@ class Dify(PluginBase):
             logger.error(traceback.format_exc())
             return None
 
-    async def dify_handle_text(self, bot: WechatAPIClient, message: dict, text: str, model_config=None):
+    @staticmethod
+    async def _iter_upload_source(source: Union[bytes, memoryview, io.IOBase, AsyncIterable[bytes]],
+                                  chunk_size: int = UPLOAD_CHUNK_SIZE) -> AsyncIterator[bytes]:
+        """将不同类型的上传来源统一为异步分块迭代"""
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            view = memoryview(source)
+            for offset in range(0, len(view), chunk_size):
+                yield view[offset:offset + chunk_size]
+        elif isinstance(source, io.IOBase):
+            while chunk := source.read(chunk_size):
+                yield chunk
+        else:
+            async for chunk in source:
+                yield chunk
+
+    async def _read_upload_source(self, source: Union[io.IOBase, AsyncIterable[bytes]]) -> bytes:
+        """将流式上传来源完整读入内存"""
+        return b"".join([bytes(chunk) async for chunk in self._iter_upload_source(source)])
+
+    async def _upload_stream(self, source, total: Optional[int], file_name: str) -> AsyncIterator[bytes]:
+        """按块产出上传数据，并记录上传进度和速率"""
+        sent = 0
+        next_report = 0.25
+        start_time = time.time()
+        async for chunk in self._iter_upload_source(source):
+            yield chunk
+            sent += len(chunk)
+            if total and sent / total >= next_report:
+                logger.debug(f"文件 {file_name} 上传进度: {sent / total:.0%} ({sent}/{total} 字节)")
+                while next_report <= sent / total:
+                    next_report += 0.25
+        elapsed = max(time.time() - start_time, 1e-6)
+        logger.info(f"文件 {file_name} 数据发送完成: {sent} 字节, 耗时 {elapsed:.2f} 秒, "
+                    f"速率 {sent / 1024 / 1024 / elapsed:.2f} MB/s")
+
+    async def dify_handle_text(self, bot: WechatAPIClient, message: dict, text: str, model_config=None,
+                               voice_sent: bool = False, prefetched: Optional[Dict[str, asyncio.Task]] = None,
+                               force_text: bool = False):
+        # voice_sent 为 True 表示文字部分已在接收流式回答时合成为语音发送
+        # force_text 为 True 时即使是语音回复也以文字发送
+        # prefetched 为接收流式回答时已经开始的链接下载：URL -> Task
         # 使用传入的model_config，如果没有则使用默认模型
         model = model_config or self.current_model
 
-        # 匹配Dify返回的图片引用格式
-        image_pattern = r'\[(.*?)\]\((.*?)\)'
-        matches = re.findall(image_pattern, text)
-
-        # 移除所有图片引用文本
-        text = re.sub(image_pattern, '', text)
+        # 一次扫描取出所有链接，下载在发送文字的同时并发进行
+        text, links = self._extract_response_links(text, model)
+        prefetched = prefetched or {}
+        fetches = [(link, prefetched.pop(link.url, None) or asyncio.create_task(self._fetch_response_link(link)))
+                   for link in links]
+        # 回答被替换后不再出现的链接不需要继续下载
+        for task in prefetched.values():
+            task.cancel()
 
         # 先发送文字内容
-        if text:
-            if message["MsgType"] == 34 or self.voice_reply_all:
+        if text and not voice_sent:
+            if (message["MsgType"] == 34 or self.voice_reply_all) and not force_text:
                 await self.text_to_voice_message(bot, message, text)
             else:
                 paragraphs = text.split("//n")
@@ -1611,83 +2463,129 @@ class Dify(PluginBase):
                     if paragraph.strip():
                         await bot.send_text_message(message["FromWxid"], paragraph.strip())
 
-        # 如果有图片引用，只处理最后一个
-        if matches:
-            filename, url = matches[-1]  # 只取最后一个图片
-            try:
-                # 如果URL是相对路径,添加base_url
-                if url.startswith('/files'):
-                    # 移除base_url中可能的v1路径
-                    base_url = model.base_url.replace('/v1', '')
-                    url = f"{base_url}{url}"
+        # 按链接在回答中出现的顺序发送
+        for link, task in fetches:
+            await self._send_response_link(bot, message, link, await task)
 
-                logger.debug(f"处理图片链接: {url}")
-                headers = {"Authorization": f"Bearer {model.api_key}"}
-                async with aiohttp.ClientSession(proxy=self.http_proxy) as session:
-                    async with session.get(url, headers=headers) as resp:
-                        if resp.status == 200:
-                            image_data = await resp.read()
-                            await bot.send_image_message(message["FromWxid"], image_data)
-                        else:
-                            logger.error(f"下载图片失败: HTTP {resp.status}")
-                            await bot.send_text_message(message["FromWxid"], f"下载图片失败: HTTP {resp.status}")
-            except Exception as e:
-                logger.error(f"处理图片 {url} 失败: {e}")
-                await bot.send_text_message(message["FromWxid"], f"处理图片失败: {str(e)}")
+    @staticmethod
+    def _extract_response_links(text: str, model: ModelConfig) -> tuple[str, list[ResponseLink]]:
+        """取出回答中的链接，返回 (去掉 Markdown 引用后的文字, 去重后的链接列表)"""
+        links: dict[str, ResponseLink] = {}
+        parts = []
+        position = 0
+        for match in RESPONSE_LINK_PATTERN.finditer(text):
+            if not match.group("file"):
+                parts.append(text[position:match.start()])
+                position = match.end()
+            link = Dify._response_link_from_match(match, model)
+            if link:
+                links.setdefault(link.url, link)
+        parts.append(text[position:])
+        return "".join(parts), list(links.values())
 
-        # 处理其他类型的链接
-        pattern = r"\]$$(https?:\/\/[^\s$$]+)\)"
-        links = re.findall(pattern, text)
-        for url in links:
+    @staticmethod
+    def _response_link_from_match(match: re.Match, model: ModelConfig) -> Optional[ResponseLink]:
+        if match.group("file"):
+            return ResponseLink(match.group("file"), is_file=True)
+        # 移除base_url中可能的v1路径
+        dify_base_url = model.base_url.replace('/v1', '')
+        url = match.group("url").strip()
+        # 如果URL是相对路径,添加base_url
+        if url.startswith('/files'):
+            url = f"{dify_base_url}{url}"
+        if not url.startswith(("http://", "https://")):
+            return None
+        # 只对 Dify 自身的文件地址携带API密钥
+        headers = {"Authorization": f"Bearer {model.api_key}"} if url.startswith(dify_base_url) else None
+        return ResponseLink(url, is_file=False, headers=headers)
+
+    def _prefetch_response_links(self, text: str, position: int, model: ModelConfig,
+                                 prefetched: Dict[str, asyncio.Task]) -> int:
+        """在流式回答中发现已完整的链接后立即开始下载，返回下一次扫描的起点"""
+        for match in RESPONSE_LINK_PATTERN.finditer(text, position):
+            # 普通链接位于文本末尾，或后面只有可能是 .gz、查询参数开头的一个字符时，可能尚未接收完整，留到下一次扫描
+            if match.group("file") and (match.end() == len(text)
+                                        or match.end() == len(text) - 1 and text[-1] in ".?#"):
+                return match.start()
+            position = match.end()
+            link = self._response_link_from_match(match, model)
+            if link and link.url not in prefetched:
+                logger.debug(f"流式回答中发现链接，提前下载: {link.url}")
+                prefetched[link.url] = asyncio.create_task(self._fetch_response_link(link))
+
+        # 引用不会跨行、普通链接不含空白，之前的文本不会再组成新的链接，下次从可能的开头继续扫描
+        line_start = max(position, text.rfind("\n") + 1)
+        word_start = max(position, max(text.rfind(char) for char in " \t\n") + 1)
+        bracket = text.find("[", line_start)
+        return min(bracket, word_start) if bracket >= 0 else word_start
+
+    async def _fetch_response_link(self, link: ResponseLink) -> Optional[tuple[bytes, str]]:
+        """在并发限制内下载回答中的链接，失败时返回 None"""
+        async with self.media_fetch_semaphore:
+            start_time = time.time()
             try:
-                file = await self.download_file(url)
-                extension = filetype.guess_extension(file)
-                if extension in ('wav', 'mp3'):
-                    await bot.send_voice_message(message["FromWxid"], voice=file, format=extension)
-                elif extension in ('jpg', 'jpeg', "png", "gif", "bmp", "svg"):
-                    await bot.send_image_message(message["FromWxid"], file)
-                elif extension in ('mp4', 'avi', 'mov', 'mkv', 'flv'):
-                    await bot.send_video_message(message["FromWxid"], video=file, image="None")
+                content, content_type = await self._fetch_media(link.url, headers=link.headers, accept_html=False)
             except Exception as e:
-                logger.error(f"下载文件 {url} 失败: {e}")
-                await bot.send_text_message(message["FromWxid"], f"下载文件 {url} 失败")
-
-        # 识别普通文件链接
-        file_pattern = r'https?://[^\s<>"]+?/[^\s<>"]+\.(?:pdf|doc|docx|xls|xlsx|txt|zip|rar|7z|tar|gz)'
-        file_links = re.findall(file_pattern, text)
-        for url in file_links:
-            await self.download_and_send_file(bot, message, url)
+                logger.error(f"下载文件 {link.url} 失败: {e}")
+                return None
+            logger.debug(f"下载链接完成: {link.url}, {len(content)} 字节, 耗时 {time.time() - start_time:.2f} 秒")
+            return content, content_type
+
+    async def _send_response_link(self, bot: WechatAPIClient, message: dict, link: ResponseLink,
+                                  result: Optional[tuple[bytes, str]]) -> None:
+        """按文件类型把下载的链接内容发送给用户"""
+        if result is None:
+            await bot.send_text_message(message["FromWxid"], f"下载文件 {link.url} 失败")
+            return
+        content, content_type = result
+        if not content:
+            return
 
-        pattern = r'\$\$[^$$]+\]\$\$https?:\/\/[^\s$$]+\)'
-        text = re.sub(pattern, '', text)
+        filename = os.path.basename(urllib.parse.urlparse(link.url).path) or "downloaded_file"
+        kind = filetype.guess(content)
+        if kind is not None:
+            extension = kind.extension
+        else:
+            # 如果无法检测文件类型,尝试从Content-Type或URL获取
+            extension = (mimetypes.guess_extension(content_type.split(";")[0].strip()) or os.path.splitext(filename)[1]).lstrip(".")
+        extension = extension.lower()
 
-    async def dify_handle_image(self, bot: WechatAPIClient, message: dict, image: Union[str, bytes], model_config=None):
         try:
-            image_content = None
+            if extension in RESPONSE_IMAGE_EXTENSIONS:
+                await self.dify_handle_image(bot, message, content)
+            elif extension in RESPONSE_VOICE_EXTENSIONS:
+                await bot.send_voice_message(message["FromWxid"], voice=content, format=extension)
+            elif extension in RESPONSE_VIDEO_EXTENSIONS:
+                await bot.send_video_message(message["FromWxid"], video=content, image="None")
+            elif link.is_file:
+                # 其他类型文件，发送文件信息
+                if not os.path.splitext(filename)[1] and extension:
+                    filename = f"{filename}.{extension}"
+                await bot.send_text_message(message["FromWxid"], f"文件名: {filename}\n内容长度: {len(content)} 字节")
+            else:
+                logger.debug(f"链接不是可发送的媒体，跳过: {link.url}")
+                return
+            logger.debug(f"链接内容发送成功: {link.url}")
+        except Exception as e:
+            logger.error(f"发送链接内容失败: {e}")
+            await bot.send_text_message(message["FromWxid"], f"处理文件失败: {str(e)}")
+
+    async def dify_handle_image(self, bot: WechatAPIClient, message: dict, image: Union[str, bytes], model_config=None,
+                                headers: Optional[dict] = None):
+        """把 Dify 返回的图片发送给用户
 
+        图片只下载一次，不再回传到 Dify；只有格式、尺寸或大小超出微信限制时才转码。
+        """
+        try:
             if isinstance(image, str) and image.startswith("http"):
                 try:
                     logger.info(f"从URL下载图片: {image}")
-                    async with aiohttp.ClientSession(proxy=self.http_proxy) as session:
-                        async with session.get(image) as resp:
-                            if resp.status == 200:
-                                image_content = await resp.read()
-                                logger.info(f"成功从URL下载图片，大小: {len(image_content)} 字节")
-
-                                # 上传到 Dify
-                                file_info = await self.upload_file_to_dify(
-                                    image_content,
-                                    f"image_{int(time.time())}.jpg",  # 生成一个有效的文件名
-                                    "image/jpeg",  # 根据实际图片类型调整
-                                    message["FromWxid"],
-                                    model_config=model_config  # 传递模型配置
-                                )
-                                if file_info:
-                                    logger.info(f"图片上传成功，文件ID: {file_info['id']}, 类型: {file_info['type']}")
-                            else:
-                                logger.error(f"下载图片失败: HTTP {resp.status}")
-                                await bot.send_text_message(message["FromWxid"], f"下载图片失败: HTTP {resp.status}")
-                                return
+                    image_content, _ = await self._fetch_media(image, headers=headers)
+                    logger.info(f"成功从URL下载图片，大小: {len(image_content)} 字节")
+                except aiohttp.ClientResponseError as e:
+                    logger.error(f"下载图片失败: HTTP {e.status}")
+                    await bot.send_text_message(message["FromWxid"], f"下载图片失败: HTTP {e.status}")
+                    return
                 except Exception as e:
                     logger.error(f"下载图片 {image} 失败: {e}")
                     logger.error(traceback.format_exc())
@@ -1696,17 +2594,6 @@ class Dify(PluginBase):
             elif isinstance(image, bytes):
                 logger.info(f"处理二进制图片数据，大小: {len(image)} 字节")
                 image_content = image
-
-                # 上传到 Dify
-                file_info = await self.upload_file_to_dify(
-                    image_content,
-                    f"image_{int(time.time())}.jpg",  # 生成一个有效的文件名
-                    "image/jpeg",  # 根据实际图片类型调整
-                    message["FromWxid"],
-                    model_config=model_config  # 传递模型配置
-                )
-                if file_info:
-                    logger.info(f"图片上传成功，文件ID: {file_info['id']}, 类型: {file_info['type']}")
             else:
                 logger.error(f"不支持的图片类型: {type(image)}")
                 await bot.send_text_message(message["FromWxid"], f"不支持的图片类型: {type(image)}")
@@ -1718,41 +2605,8 @@ class Dify(PluginBase):
                 await bot.send_text_message(message["FromWxid"], "图片内容为空，无法发送")
                 return
 
-            # 验证图片数据
             try:
-                # 允许加载截断的图片
-                from PIL import ImageFile
-                ImageFile.LOAD_TRUNCATED_IMAGES = True
-
-                # 验证图片数据
-                img = Image.open(io.BytesIO(image_content))
-                logger.info(f"图片验证成功，格式: {img.format}, 大小: {img.size}, 模式: {img.mode}")
-
-                # 检查图片大小，如果太大则调整大小
-                width, height = img.size
-                max_dimension = 1600  # 最大尺寸限制
-
-                if width > max_dimension or height > max_dimension:
-                    # 计算缩放比例
-                    ratio = min(max_dimension / width, max_dimension / height)
-                    new_width = int(width * ratio)
-                    new_height = int(height * ratio)
-                    logger.info(f"图片尺寸过大，调整大小从 {width}x{height} 到 {new_width}x{new_height}")
-                    img = img.resize((new_width, new_height), Image.LANCZOS)
-
-                    # 转换为RGB模式(去除alpha通道)
-                    if img.mode in ('RGBA', 'LA'):
-                        logger.debug(f"图片包含alpha通道，转换为RGB模式")
-                        background = Image.new('RGB', img.size, (255, 255, 255))
-                        background.paste(img, mask=img.split()[-1])
-                        img = background
-
-                    # 保存为JPEG
-                    output = io.BytesIO()
-                    img.save(output, format='JPEG', quality=95, optimize=True)
-                    output.seek(0)
-                    image_content = output.getvalue()
-                    logger.info(f"图片处理成功，新大小: {len(image_content)} 字节")
+                image_content = await asyncio.to_thread(self._prepare_outbound_image, image_content)
             except Exception as e:
                 logger.error(f"图片验证或处理失败: {e}")
                 logger.error(traceback.format_exc())
@@ -1767,6 +2621,43 @@ class Dify(PluginBase):
             logger.error(traceback.format_exc())
             await bot.send_text_message(message["FromWxid"], f"处理图片失败: {str(e)}")
 
+    @classmethod
+    def _prepare_outbound_image(cls, image_content: bytes) -> bytes:
+        """检查图片能否直接发送给微信，不能时缩放并转为 JPEG"""
+        # 允许加载截断的图片
+        from PIL import ImageFile
+        ImageFile.LOAD_TRUNCATED_IMAGES = True
+
+        # Image.open 只读取文件头，不解码像素
+        with Image.open(io.BytesIO(image_content)) as probe:
+            image_format, (width, height) = probe.format, probe.size
+        logger.info(f"图片验证成功，格式: {image_format}, 原始大小: {width}x{height}, {len(image_content)} 字节")
+        if (image_format in WECHAT_IMAGE_FORMATS and max(width, height) <= IMAGE_MAX_DIMENSION
+                and len(image_content) <= WECHAT_IMAGE_MAX_BYTES):
+            return image_content
+
+        # 超过尺寸限制时直接以降低的分辨率解码并缩放
+        img, _ = cls._open_image_scaled(image_content)
+        # 转换为RGB模式(去除alpha通道)
+        if img.mode in ('RGBA', 'LA', 'P'):
+            img = img.convert('RGBA')
+            background = Image.new('RGB', img.size, (255, 255, 255))
+            background.paste(img, mask=img.split()[-1])
+            img = background
+        elif img.mode != 'RGB':
+            img = img.convert('RGB')
+
+        # 保存为JPEG，超过大小限制时逐步降低质量
+        quality = 95
+        while True:
+            output = io.BytesIO()
+            img.save(output, format='JPEG', quality=quality, optimize=True)
+            if output.tell() <= WECHAT_IMAGE_MAX_BYTES or quality <= 50:
+                break
+            quality -= 10
+        logger.info(f"图片转码成功，质量: {quality}，新大小: {output.tell()} 字节")
+        return output.getvalue()
+
     @staticmethod
     async def dify_handle_error(bot: WechatAPIClient, message: dict, task_id: str, message_id: str, status: str,
                                 code: int, err_message: str):
@@ -1822,89 +2713,295 @@ class Dify(PluginBase):
             self.db.add_points(wxid, -((model_config or self.current_model).price))
             return True
 
-    async def audio_to_text(self, bot: WechatAPIClient, message: dict) -> str:
-        if not shutil.which("ffmpeg"):
+    @staticmethod
+    def _model_cache_id(model: ModelConfig) -> str:
+        """区分模型的缓存标识，同一 base-url 下不同的 Dify 应用按 API 密钥区分"""
+        return f"{model.base_url}|{hashlib.sha256(model.api_key.encode()).hexdigest()[:16]}"
+
+    async def audio_to_text(self, bot: WechatAPIClient, message: dict) -> Optional[str]:
+        """把语音交给转写工作池，队列已满时返回 None"""
+        sender_wxid = message["SenderWxid"]
+        voice_data = message["Content"]
+
+        # 转发的语音和重复的语音指令直接使用缓存的转写结果
+        model = self.get_user_model(sender_wxid)
+        cache_key = f"{self._model_cache_id(model)}|{hashlib.sha256(voice_data).hexdigest()}" \
+            if isinstance(voice_data, bytes) else None
+        if cache_key:
+            cache_data = self.transcript_cache.get("transcript", cache_key)
+            if cache_data is not None:
+                stats = self.transcript_cache.stats
+                logger.info(f"语音转写缓存命中: {cache_data.content.decode()}，"
+                            f"累计命中 {stats['hits']} 次，未命中 {stats['misses']} 次")
+                return cache_data.content.decode()
+
+        if not shutil.which("ffmpeg") and not (has_silk_decoder and self._is_silk(message["Content"])):
             logger.error("未找到ffmpeg，请安装并配置到环境变量")
             await bot.send_text_message(message["FromWxid"], "服务器缺少ffmpeg，无法处理语音")
             return ""
 
-        silk_file = "temp_audio.silk"
-        mp3_file = "temp_audio.mp3"
+        if sender_wxid in self.admins:
+            priority = TranscriptionService.PRIORITY_ADMIN
+        elif not message.get("IsGroup"):
+            priority = TranscriptionService.PRIORITY_PRIVATE
+        else:
+            priority = TranscriptionService.PRIORITY_GROUP
+
+        future = self.transcription_service.submit(voice_data, sender_wxid, priority)
+        if future is None:
+            return None
         try:
-            with open(silk_file, "wb") as f:
-                f.write(message["Content"])
+            text = await future
+        except Exception as e:
+            logger.error(f"语音处理失败: {e}")
+            return ""
+
+        if text and cache_key:
+            content = text.encode()
+            self.transcript_cache.put("transcript", [cache_key], MediaEntry(
+                content=content, mime_type="text/plain", ttl=self.transcript_cache_ttl, size=len(content)))
+        return text
 
-            command = f"ffmpeg -y -i {silk_file} -ar 16000 -ac 1 -f mp3 {mp3_file}"
-            process = subprocess.run(command, shell=True, check=True, capture_output=True, text=True)
-            if process.returncode != 0:
-                logger.error(f"ffmpeg 执行失败: {process.stderr}")
+    async def _transcribe_voice(self, voice_data: bytes, user_wxid: str) -> str:
+        """转码并识别一条语音，由转写工作池调用"""
+        try:
+            # 一次解码得到 PCM，Dify 接口和本地识别都从这份数据派生
+            pcm_data = await self._decode_voice(voice_data)
+            if not pcm_data:
                 return ""
 
+            if self.local_stt_primary:
+                text = await self.local_recognizer.recognize(pcm_data)
+                if text:
+                    return text
+                logger.warning("本地语音识别没有结果，改用 Dify 接口")
+
             # 使用当前模型的 base-url 构建音频转文本 URL
-            model = self.get_user_model(message["SenderWxid"])
+            model = self.get_user_model(user_wxid)
             audio_to_text_url = f"{model.base_url}/audio-to-text"
             logger.debug(f"使用音频转文本 URL: {audio_to_text_url}")
 
-            headers = {"Authorization": f"Bearer {model.api_key}"}
-            formdata = aiohttp.FormData()
-            with open(mp3_file, "rb") as f:
-                mp3_data = f.read()
-            formdata.add_field("file", mp3_data, filename="audio.mp3", content_type="audio/mp3")
-            formdata.add_field("user", message["SenderWxid"])
-            async with aiohttp.ClientSession(proxy=self.http_proxy) as session:
-                async with session.post(audio_to_text_url, headers=headers, data=formdata) as resp:
-                    if resp.status == 200:
-                        result = await resp.json()
-                        text = result.get("text", "")
-                        if "failed" in text.lower() or "code" in text.lower():
-                            logger.error(f"Dify API 返回错误: {text}")
+            try:
+                headers = {"Authorization": f"Bearer {model.api_key}"}
+                formdata = aiohttp.FormData()
+                formdata.add_field("file", self._pcm_to_wav(pcm_data), filename="audio.wav", content_type="audio/wav")
+                formdata.add_field("user", user_wxid)
+                async with aiohttp.ClientSession(proxy=self.http_proxy) as session:
+                    async with session.post(audio_to_text_url, headers=headers, data=formdata) as resp:
+                        if resp.status == 200:
+                            result = await resp.json()
+                            text = result.get("text", "")
+                            if "failed" in text.lower() or "code" in text.lower():
+                                logger.error(f"Dify API 返回错误: {text}")
+                            else:
+                                logger.info(f"语音转文字结果 (Dify API): {text}")
+                                return text
                         else:
-                            logger.info(f"语音转文字结果 (Dify API): {text}")
-                            return text
-                    else:
-                        logger.error(f"audio-to-text 接口调用失败: {resp.status} - {await resp.text()})")
+                            logger.error(f"audio-to-text 接口调用失败: {resp.status} - {await resp.text()})")
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logger.error(f"audio-to-text 接口请求异常: {e}")
 
-            command = f"ffmpeg -y -i {mp3_file} {silk_file.replace('.silk', '.wav')}"
-            process = subprocess.run(command, shell=True, check=True, capture_output=True, text=True)
-            if process.returncode != 0:
-                logger.error(f"ffmpeg 转为 WAV 失败: {process.stderr}")
+            if self.local_stt_primary:
                 return ""
-
-            r = sr.Recognizer()
-            with sr.AudioFile(silk_file.replace('.silk', '.wav')) as source:
-                audio = r.record(source)
-            text = r.recognize_google(audio, language="zh-CN")
-            logger.info(f"语音转文字结果 (Google): {text}")
-            return text
+            # Dify 接口失败时使用本地识别引擎
+            return await self.local_recognizer.recognize(pcm_data)
         except Exception as e:
             logger.error(f"语音处理失败: {e}")
             return ""
-        finally:
-            for temp_file in [silk_file, mp3_file, silk_file.replace('.silk', '.wav')]:
-                if os.path.exists(temp_file):
-                    os.remove(temp_file)
+
+    @staticmethod
+    def _is_silk(voice_data) -> bool:
+        """判断是否为 SILK 编码的语音（微信语音会在文件头前多一个 0x02 字节）"""
+        return isinstance(voice_data, (bytes, bytearray)) and voice_data[:10].lstrip(b"\x02").startswith(b"#!SILK_V3")
+
+    @staticmethod
+    def _decode_silk(voice_data: bytes) -> bytes:
+        """在进程内把 SILK 语音解码为 16kHz 单声道 16 位 PCM"""
+        output = io.BytesIO()
+        pysilk.decode(io.BytesIO(voice_data), output, VOICE_SAMPLE_RATE)
+        return output.getvalue()
+
+    async def _decode_voice(self, voice_data: bytes) -> Optional[bytes]:
+        """把语音解码为 16kHz 单声道 16 位 PCM
+
+        安装了 SILK 解码器时在线程中直接解码，省去启动 ffmpeg 的开销；
+        否则通过管道调用 ffmpeg，数据经标准输入输出传递，不落临时文件。
+        """
+        if has_silk_decoder and self._is_silk(voice_data):
+            try:
+                pcm_data = await asyncio.to_thread(self._decode_silk, voice_data)
+                if pcm_data:
+                    logger.debug(f"SILK 语音解码完成，PCM 大小: {len(pcm_data)} 字节")
+                    return pcm_data
+                logger.warning("SILK 解码结果为空，改用 ffmpeg")
+            except Exception as e:
+                logger.warning(f"SILK 解码失败，改用 ffmpeg: {e}")
+            if not shutil.which("ffmpeg"):
+                logger.error("未找到ffmpeg，无法解码语音")
+                return None
+
+        process = await asyncio.create_subprocess_exec(
+            "ffmpeg", "-hide_banner", "-loglevel", "error",
+            "-i", "pipe:0",
+            "-f", "s16le", "-acodec", "pcm_s16le", "-ar", str(VOICE_SAMPLE_RATE), "-ac", "1",
+            "pipe:1",
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        try:
+            # communicate 同时写入和读取管道，避免缓冲区写满导致死锁
+            stdout, stderr = await asyncio.wait_for(process.communicate(voice_data), timeout=VOICE_TRANSCODE_TIMEOUT)
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+            logger.error(f"ffmpeg 转码超时（{VOICE_TRANSCODE_TIMEOUT} 秒）")
+            return None
+        except asyncio.CancelledError:
+            process.kill()
+            await process.wait()
+            raise
+
+        if process.returncode != 0:
+            logger.error(f"ffmpeg 执行失败: {stderr.decode(errors='ignore')}")
+            return None
+        if not stdout:
+            logger.error("ffmpeg 未输出音频数据")
+            return None
+        logger.debug(f"语音解码完成，PCM 大小: {len(stdout)} 字节")
+        return stdout
+
+    @staticmethod
+    def _pcm_to_wav(pcm_data: bytes) -> bytes:
+        """在内存中为 PCM 数据加上 WAV 文件头"""
+        buffer = io.BytesIO()
+        with wave.open(buffer, "wb") as wav_file:
+            wav_file.setnchannels(1)
+            wav_file.setsampwidth(VOICE_SAMPLE_WIDTH)
+            wav_file.setframerate(VOICE_SAMPLE_RATE)
+            wav_file.writeframes(pcm_data)
+        return buffer.getvalue()
 
     async def text_to_voice_message(self, bot: WechatAPIClient, message: dict, text: str):
+        """按句子分段并发合成语音，按顺序尽早发送"""
         try:
-            # 使用当前模型的 base-url 构建文本转音频 URL
-            model = self.get_user_model(message["SenderWxid"])
-            text_to_audio_url = f"{model.base_url}/text-to-audio"
-            logger.debug(f"使用文本转音频 URL: {text_to_audio_url}")
-
-            headers = {"Authorization": f"Bearer {model.api_key}", "Content-Type": "application/json"}
-            data = {"text": text, "user": message["SenderWxid"]}
-            async with aiohttp.ClientSession(proxy=self.http_proxy) as session:
-                async with session.post(text_to_audio_url, headers=headers, json=data) as resp:
-                    if resp.status == 200:
-                        audio = await resp.read()
-                        await bot.send_voice_message(message["FromWxid"], voice=audio, format="mp3")
-                    else:
-                        logger.error(f"text-to-audio 接口调用失败: {resp.status} - {await resp.text()}")
-                        await bot.send_text_message(message["FromWxid"], TEXT_TO_VOICE_FAILED)
+            pipeline = self._create_speech_pipeline(bot, message)
+            splitter = SentenceSplitter(self.tts_segment_max_chars)
+            for segment in splitter.push(text) + splitter.flush():
+                pipeline.feed(segment)
+            await pipeline.finish()
         except Exception as e:
             logger.error(f"text-to-audio 接口调用异常: {e}")
             await bot.send_text_message(message["FromWxid"], f"{TEXT_TO_VOICE_FAILED}: {str(e)}")
 
+    def _create_speech_pipeline(self, bot: WechatAPIClient, message: dict) -> SpeechPipeline:
+        # 使用当前模型的 base-url 构建文本转音频 URL
+        model = self.get_user_model(message["SenderWxid"])
+        return SpeechPipeline(
+            functools.partial(self._synthesize_speech, model, user=message["SenderWxid"]),
+            lambda audio: bot.send_voice_message(message["FromWxid"], voice=audio, format="mp3"),
+            lambda segment: bot.send_text_message(message["FromWxid"], segment),
+        )
+
+    def _load_tts_cache(self) -> None:
+        """从磁盘恢复语音合成缓存，按修改时间由旧到新加入 LRU"""
+        now = time.time()
+        cached_files = []
+        for file_name in os.listdir(self.tts_cache_dir):
+            path = os.path.join(self.tts_cache_dir, file_name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            if not file_name.endswith(".mp3") or now - stat.st_mtime > self.tts_cache_ttl:
+                try:
+                    os.remove(path)
+                except OSError as e:
+                    logger.warning(f"清理语音缓存文件失败: {e}")
+                continue
+            cached_files.append((stat.st_mtime, stat.st_size, file_name, path))
+
+        for mtime, size, file_name, path in sorted(cached_files):
+            self.tts_cache.put("tts", [file_name[:-4]], MediaEntry(
+                name=file_name, mime_type="audio/mpeg", ttl=self.tts_cache_ttl, timestamp=mtime, size=size, path=path))
+        if cached_files:
+            logger.info(f"已加载语音合成缓存: {len(cached_files)} 个文件, {self.tts_cache.total_bytes} 字节")
+
+    @staticmethod
+    def _tts_cache_key(model: ModelConfig, text: str) -> str:
+        # 合并空白后再计算，只有空白不同的文本共用缓存
+        normalized = re.sub(r"\s+", " ", text.strip())
+        # 同一 base-url 下的不同 Dify 应用有各自的音色设置，按应用区分
+        return hashlib.sha256(f"{Dify._model_cache_id(model)}\n{normalized}".encode()).hexdigest()
+
+    def _get_cached_speech(self, cache_key: str) -> Optional[bytes]:
+        entry = self.tts_cache.get("tts", cache_key)
+        if entry is None:
+            return None
+        try:
+            with open(entry.path, "rb") as f:
+                audio = f.read()
+            # 更新修改时间，重启后仍按最近使用排序
+            os.utime(entry.path)
+        except OSError as e:
+            logger.warning(f"读取语音缓存失败: {e}")
+            self.tts_cache.remove("tts", cache_key)
+            return None
+        stats = self.tts_cache.stats
+        logger.debug(f"语音合成缓存命中: {cache_key[:12]}, 累计命中 {stats['hits']} 次，未命中 {stats['misses']} 次")
+        return audio
+
+    def _cache_speech(self, cache_key: str, audio: bytes) -> None:
+        path = os.path.join(self.tts_cache_dir, f"{cache_key}.mp3")
+        temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        try:
+            with open(temp_path, "wb") as f:
+                f.write(audio)
+            os.replace(temp_path, path)
+        except OSError as e:
+            logger.warning(f"写入语音缓存失败: {e}")
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            return
+        # 相同文本同时合成时另一方可能已经登记，重新 put 会释放旧条目并删除刚写入的同名文件
+        existing = self.tts_cache.peek("tts", cache_key)
+        if existing is not None:
+            existing.timestamp = time.time()
+            self.tts_cache.update_size(existing, len(audio))
+            return
+        self.tts_cache.put("tts", [cache_key], MediaEntry(
+            name=os.path.basename(path), mime_type="audio/mpeg", ttl=self.tts_cache_ttl, size=len(audio), path=path))
+
+    async def _synthesize_speech(self, model: ModelConfig, text: str, user: str) -> Optional[bytes]:
+        """调用 Dify text-to-audio 合成一段语音，失败时返回 None
+
+        相同模型和文本的合成结果缓存在磁盘上，命中时不再请求接口。
+        """
+        cache_key = self._tts_cache_key(model, text)
+        audio = self._get_cached_speech(cache_key)
+        if audio:
+            return audio
+
+        text_to_audio_url = f"{model.base_url}/text-to-audio"
+        headers = {"Authorization": f"Bearer {model.api_key}", "Content-Type": "application/json"}
+        data = {"text": text, "user": user}
+        async with self.tts_semaphore:
+            start_time = time.time()
+            try:
+                async with aiohttp.ClientSession(proxy=self.http_proxy) as session:
+                    async with session.post(text_to_audio_url, headers=headers, json=data) as resp:
+                        if resp.status == 200:
+                            audio = await resp.read()
+                            if audio:
+                                self._cache_speech(cache_key, audio)
+                            logger.debug(f"语音分段合成完成: {len(text)} 字, {len(audio)} 字节, "
+                                         f"耗时 {time.time() - start_time:.2f} 秒")
+                            return audio
+                        logger.error(f"text-to-audio 接口调用失败: {resp.status} - {await resp.text()}")
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logger.error(f"text-to-audio 接口请求异常: {e}")
+        return None
+
     @on_image_message(priority=20)
     async def handle_image(self, bot: WechatAPIClient, message: dict):
         """处理图片消息"""
@@ -1921,6 +3018,7 @@ class Dify(PluginBase):
 
             # 直接从消息中获取图片内容
             image_content = None
+            image_loader = None  # 延迟下载时使用的加载函数
             xml_content = message.get("Content")
 
             # 如果是二进制数据，直接使用
@@ -1988,7 +3086,7 @@ class Dify(PluginBase):
                     logger.debug("图片内容是字符串，尝试解析XML")
                     try:
                         # 尝试解析XML获取图片信息
-                        root = ET.fromstring(xml_content)
+                        root = self._parse_xml(xml_content)
                         img_element = root.find('img')
 
                         if img_element is not None:
@@ -1996,81 +3094,41 @@ class Dify(PluginBase):
                             md5 = img_element.get('md5')
                             aeskey = img_element.get('aeskey')
                             length = img_element.get('length')
-                            cdnmidimgurl = img_element.get('cdnmidimgurl')
-                            cdnthumburl = img_element.get('cdnthumburl')
 
                             logger.info(f"从XML解析到图片信息: md5={md5}, aeskey={aeskey}, length={length}")
-
-                            # 尝试使用PAD API下载图片
-                            try:
-                                # 从 XML 中提取图片大小
-                                img_length = int(length) if length and length.isdigit() else 0
-
-                                # 使用消息 ID 下载图片 - 实现分段下载
-                                logger.debug(f"尝试使用消息 ID {msg_id} 下载图片，图片大小: {img_length}")
-
-                                # 创建一个字节数组来存储完整的图片数据
-                                full_image_data = bytearray()
-
-                                # 分段下载大图片
-                                chunk_size = 64 * 1024  # 64KB
-                                chunks = (img_length + chunk_size - 1) // chunk_size  # 向上取整
-
-                                logger.info(f"开始分段下载图片，总大小: {img_length} 字节，分 {chunks} 段下载")
-
-                                download_success = True
-                                for i in range(chunks):
-                                    try:
-                                        # 下载当前段
-                                        chunk_data = await bot.get_msg_image(msg_id, from_wxid, img_length, start_pos=i*chunk_size)
-                                        if chunk_data and len(chunk_data) > 0:
-                                            full_image_data.extend(chunk_data)
-                                            logger.debug(f"第 {i+1}/{chunks} 段下载成功，大小: {len(chunk_data)} 字节")
-                                        else:
-                                            logger.error(f"第 {i+1}/{chunks} 段下载失败，数据为空")
-                                            download_success = False
-                                            break
-                                    except Exception as e:
-                                        logger.error(f"下载第 {i+1}/{chunks} 段时出错: {e}")
-                                        download_success = False
-                                        break
-
-                                if download_success and len(full_image_data) > 0:
-                                    # 验证图片数据
-                                    try:
-                                        image_data = bytes(full_image_data)
-                                        Image.open(io.BytesIO(image_data))
-                                        image_content = image_data
-                                        logger.info(f"使用消息 ID下载图片成功，总大小: {len(image_data)} 字节")
-                                    except Exception as img_error:
-                                        logger.error(f"下载的图片数据无效: {img_error}")
-                                else:
-                                    logger.error(f"图片分段下载失败，已下载: {len(full_image_data)}/{img_length} 字节")
-                            except Exception as download_error:
-                                logger.error(f"使用消息 ID下载图片失败: {download_error}")
-                                logger.error(traceback.format_exc())
+                            if self.image_lazy_download:
+                                # 只记录图片元数据，等到有查询使用这张图片时再下载
+                                image_loader = functools.partial(self._acquire_image, bot, msg_id, from_wxid, img_element)
+                                logger.info(f"已记录图片元数据，将在使用时下载: MsgId={msg_id}")
+                            else:
+                                image_content = await self._acquire_image(bot, msg_id, from_wxid, img_element)
                     except Exception as xml_error:
                         logger.error(f"XML解析失败: {xml_error}")
                         logger.debug(f"XML内容前100字符: {xml_content[:100]}")
             else:
                 logger.error(f"图片消息内容格式未知: {type(xml_content)}")
 
-            # 如果成功获取图片内容，则缓存
-            if image_content:
-                # 缓存图片到发送者和收件人的ID
-                self.image_cache[sender_wxid] = {
-                    "content": image_content,
-                    "timestamp": time.time()
-                }
+            # 如果成功获取图片内容或图片元数据，则缓存
+            if image_content or image_loader:
+                # 发送者和聊天对象共用同一个缓存条目，数据只存一份，延迟下载也只进行一次
+                self.media_cache.put("image", [sender_wxid, from_wxid], MediaEntry(
+                    content=image_content,
+                    ttl=self.image_cache_timeout,
+                    size=len(image_content) if image_content else 0,
+                    loader=image_loader
+                ))
                 logger.info(f"已缓存用户 {sender_wxid} 的图片")
 
-                # 如果是私聊，也缓存到聊天对象的ID
-                if from_wxid != sender_wxid:
-                    self.image_cache[from_wxid] = {
-                        "content": image_content,
+                # 私聊图片几乎总会跟着提问，提前在后台上传到用户当前的模型
+                if self.image_preupload and not message.get("IsGroup"):
+                    model = self.get_user_model(sender_wxid)
+                    self._prune_image_upload_tasks(from_wxid)
+                    self.image_upload_tasks[from_wxid] = {
+                        "model": model,
+                        "task": asyncio.create_task(self._preupload_image(from_wxid, model)),
                         "timestamp": time.time()
                     }
-                    logger.info(f"已缓存聊天对象 {from_wxid} 的图片")
+                    logger.info(f"已开始预上传用户 {from_wxid} 的图片")
             else:
                 logger.warning(f"未能获取图片内容，无法缓存")
 
@@ -2078,164 +3136,527 @@ class Dify(PluginBase):
             logger.error(f"处理图片消息失败: {e}")
             logger.error(f"错误详情: {traceback.format_exc()}")
 
-    async def get_cached_image(self, user_wxid: str) -> Optional[bytes]:
-        """获取用户最近的图片"""
-        logger.debug(f"尝试获取用户 {user_wxid} 的缓存图片")
-        if user_wxid in self.image_cache:
-            cache_data = self.image_cache[user_wxid]
-            current_time = time.time()
-            cache_age = current_time - cache_data["timestamp"]
-            logger.debug(f"找到缓存图片，年龄: {cache_age:.2f}秒, 超时时间: {self.image_cache_timeout}秒")
+    @staticmethod
+    def _xml_int(element: ET.Element, attr: str) -> int:
+        """读取XML元素的整数属性，缺失或非法时返回0"""
+        value = element.get(attr)
+        return int(value) if value and value.isdigit() else 0
+
+    async def _acquire_image(self, bot: WechatAPIClient, msg_id, from_wxid: str, img_element: ET.Element) -> Optional[Union[bytes, memoryview]]:
+        """按分辨率选择图片来源，优先下载满足上传目标的最小CDN版本，否则下载原图"""
+        img_length = self._xml_int(img_element, 'length')
+        aeskey = img_element.get('aeskey')
+
+        if self.image_download_mode == "auto" and aeskey:
+            # 原图尺寸未知时以配置的最小边长为目标
+            original_side = max(self._xml_int(img_element, 'cdnhdwidth'), self._xml_int(img_element, 'cdnhdheight'))
+            target_side = min(self.image_min_dimension, original_side) if original_side else self.image_min_dimension
+
+            # (名称, CDN地址, AES密钥, 已知长边, 尺寸未知时是否尝试)，按从小到大排列
+            variants = [
+                ("缩略图", img_element.get('cdnthumburl'), img_element.get('cdnthumbaeskey') or aeskey,
+                 max(self._xml_int(img_element, 'cdnthumbwidth'), self._xml_int(img_element, 'cdnthumbheight')), False),
+                ("中图", img_element.get('cdnmidimgurl'), aeskey,
+                 max(self._xml_int(img_element, 'cdnmidwidth'), self._xml_int(img_element, 'cdnmidheight')), True),
+            ]
+            for name, cdn_url, cdn_aeskey, known_side, probe_unknown in variants:
+                if not cdn_url:
+                    continue
+                if known_side and known_side < target_side:
+                    logger.debug(f"{name}长边 {known_side} 小于目标 {target_side}，跳过")
+                    continue
+                if not known_side and not probe_unknown:
+                    continue
+
+                image_data = await self._download_cdn_image(bot, cdn_aeskey, cdn_url)
+                if not image_data:
+                    continue
+                try:
+                    width, height = Image.open(io.BytesIO(image_data)).size
+                except Exception as e:
+                    logger.warning(f"{name}数据无效: {e}")
+                    continue
+
+                if max(width, height) >= target_side or (img_length and len(image_data) >= img_length):
+                    logger.info(f"使用{name}作为图片来源，尺寸: {width}x{height}，大小: {len(image_data)} 字节")
+                    return image_data
+                logger.debug(f"{name}尺寸 {width}x{height} 不满足目标 {target_side}，继续尝试更大版本")
+
+        return await self._download_original_image(bot, msg_id, from_wxid, img_length)
+
+    @staticmethod
+    async def _download_cdn_image(bot: WechatAPIClient, aeskey: str, cdn_url: str) -> Optional[bytes]:
+        """通过CDN地址下载图片"""
+        try:
+            image_data = await bot.download_image(aeskey, cdn_url)
+            if isinstance(image_data, str):
+                image_data = base64.b64decode(image_data)
+            return image_data or None
+        except Exception as e:
+            logger.warning(f"CDN图片下载失败: {e}")
+            return None
+
+    @staticmethod
+    async def _download_original_image(bot: WechatAPIClient, msg_id, from_wxid: str, img_length: int) -> Optional[memoryview]:
+        """使用消息 ID 分段下载原图，返回只读视图"""
+        try:
+            logger.debug(f"尝试使用消息 ID {msg_id} 下载图片，图片大小: {img_length}")
+
+            # 按图片大小预分配缓冲区，各分段写入对应偏移
+            full_image_data = bytearray(img_length)
+            received_end = 0
+
+            # 分段下载大图片
+            chunk_size = 64 * 1024  # 64KB
+            chunks = (img_length + chunk_size - 1) // chunk_size  # 向上取整
+
+            logger.info(f"开始分段下载图片，总大小: {img_length} 字节，分 {chunks} 段下载")
 
-            if cache_age <= self.image_cache_timeout:
+            for i in range(chunks):
                 try:
-                    # 确保我们有有效的二进制数据
-                    image_content = cache_data["content"]
-                    if not isinstance(image_content, bytes):
-                        logger.error("缓存的图片内容不是二进制格式")
-                        del self.image_cache[user_wxid]
+                    # 下载当前段
+                    chunk_data = await bot.get_msg_image(msg_id, from_wxid, img_length, start_pos=i*chunk_size)
+                    if chunk_data and len(chunk_data) > 0:
+                        offset = i * chunk_size
+                        full_image_data[offset:offset + len(chunk_data)] = chunk_data
+                        received_end = max(received_end, offset + len(chunk_data))
+                        logger.debug(f"第 {i+1}/{chunks} 段下载成功，大小: {len(chunk_data)} 字节")
+                    else:
+                        logger.error(f"第 {i+1}/{chunks} 段下载失败，数据为空")
                         return None
+                except Exception as e:
+                    logger.error(f"下载第 {i+1}/{chunks} 段时出错: {e}")
+                    return None
 
-                    # 尝试验证图片数据
-                    try:
-                        img = Image.open(io.BytesIO(image_content))
-                        logger.debug(f"缓存图片验证成功，格式: {img.format}, 大小: {len(image_content)} 字节")
-                    except Exception as e:
-                        logger.error(f"缓存的图片数据无效: {e}")
-                        del self.image_cache[user_wxid]
-                        return None
+            if not received_end:
+                logger.error(f"图片分段下载失败，已下载: {received_end}/{img_length} 字节")
+                return None
 
-                    # 不再删除缓存，而是在上传成功后删除
-                    # 更新时间戳，避免过早超时
-                    self.image_cache[user_wxid]["timestamp"] = current_time
-                    logger.info(f"成功获取用户 {user_wxid} 的缓存图片")
-                    return image_content
-                except Exception as e:
-                    logger.error(f"处理缓存图片失败: {e}")
-                    del self.image_cache[user_wxid]
+            # 验证图片数据
+            try:
+                image_data = memoryview(full_image_data)[:received_end].toreadonly()
+                Image.open(io.BytesIO(image_data))
+                logger.info(f"使用消息 ID下载图片成功，总大小: {len(image_data)} 字节")
+                return image_data
+            except Exception as img_error:
+                logger.error(f"下载的图片数据无效: {img_error}")
+        except Exception as download_error:
+            logger.error(f"使用消息 ID下载图片失败: {download_error}")
+            logger.error(traceback.format_exc())
+        return None
+
+    async def _preupload_image(self, user_wxid: str, model: ModelConfig) -> Optional[dict]:
+        """在后台下载并上传图片到 Dify，保留图片缓存以便模型不一致时重新上传"""
+        image_content = await self.get_cached_image(user_wxid)
+        if not image_content:
+            return None
+        cache_entry = self.media_cache.get("image", user_wxid)
+        file_info = await self.upload_file_to_dify(
+            image_content,
+            f"image_{int(time.time())}.jpg",
+            "image/jpeg",
+            user_wxid,
+            model_config=model
+        )
+        # 上传期间用户可能发送了新图片，只在键仍指向原条目（或已被上传清除）时恢复
+        if cache_entry is not None and self.media_cache.peek("image", user_wxid) in (None, cache_entry):
+            self.media_cache.put("image", [user_wxid], cache_entry)
+        return file_info
+
+    def _prune_image_upload_tasks(self, user_wxid: str) -> None:
+        """取消该用户被新图片取代的预上传任务，并清理超过图片缓存时间仍未被使用的预上传"""
+        now = time.time()
+        for key, preupload in list(self.image_upload_tasks.items()):
+            if key == user_wxid or now - preupload["timestamp"] > self.image_cache_timeout:
+                preupload["task"].cancel()
+                del self.image_upload_tasks[key]
+
+    async def get_image_files(self, user_wxid: str, model: ModelConfig) -> list:
+        """获取用户最近图片对应的 Dify 文件列表，优先使用预上传的结果"""
+        preupload = self.image_upload_tasks.pop(user_wxid, None)
+        if (preupload and preupload["model"] == model
+                and time.time() - preupload["timestamp"] <= self.image_cache_timeout):
+            try:
+                # 预上传可能仍在进行，等待其完成
+                file_info = await preupload["task"]
+            except Exception as e:
+                logger.error(f"图片预上传失败: {e}")
+                file_info = None
+            if file_info:
+                logger.debug(f"使用预上传的图片，文件ID: {file_info['id']}")
+                self.media_cache.remove("image", user_wxid)
+                return [file_info]
+
+        image_content = await self.get_cached_image(user_wxid)
+        if not image_content:
+            return []
+        try:
+            logger.debug("发现最近的图片，准备上传到 Dify")
+            file_info = await self.upload_file_to_dify(
+                image_content,
+                f"image_{int(time.time())}.jpg",  # 生成一个有效的文件名
+                "image/jpeg",
+                user_wxid,
+                model_config=model  # 传递正确的模型配置
+            )
+            if file_info:
+                logger.debug(f"图片上传成功，文件ID: {file_info['id']}")
+                return [file_info]
+            logger.error("图片上传失败")
+        except Exception as e:
+            logger.error(f"处理图片失败: {e}")
+        return []
+
+    async def get_cached_image(self, user_wxid: str) -> Optional[Union[bytes, memoryview]]:
+        """获取用户最近的图片"""
+        logger.debug(f"尝试获取用户 {user_wxid} 的缓存图片")
+        cache_data = self.media_cache.get("image", user_wxid)
+        if cache_data is None:
+            logger.debug(f"未找到用户 {user_wxid} 的缓存图片或已超时")
+            return None
+
+        try:
+            # 确保我们有有效的二进制数据
+            image_content = cache_data.content
+            if image_content is None and cache_data.loader:
+                logger.debug(f"缓存图片尚未下载，开始按需下载")
+                image_content = await self._load_media_entry(cache_data)
+                if not image_content:
+                    logger.error("按需下载图片失败")
+                    self.media_cache.remove("image", user_wxid)
                     return None
+
+            if not isinstance(image_content, (bytes, memoryview)):
+                logger.error("缓存的图片内容不是二进制格式")
+                self.media_cache.remove("image", user_wxid)
+                return None
+
+            # 尝试验证图片数据
+            try:
+                img = Image.open(io.BytesIO(image_content))
+                logger.debug(f"缓存图片验证成功，格式: {img.format}, 大小: {len(image_content)} 字节")
+            except Exception as e:
+                logger.error(f"缓存的图片数据无效: {e}")
+                self.media_cache.remove("image", user_wxid)
+                return None
+
+            # 不再删除缓存，而是在上传成功后删除
+            logger.info(f"成功获取用户 {user_wxid} 的缓存图片")
+            return image_content
+        except Exception as e:
+            logger.error(f"处理缓存图片失败: {e}")
+            self.media_cache.remove("image", user_wxid)
+            return None
+
+    async def _load_media_entry(self, entry: MediaEntry, spill: bool = False) -> Optional[Union[bytes, memoryview]]:
+        """按需下载缓存条目的数据，并发请求共享同一次下载"""
+        if entry.task is None:
+            entry.task = asyncio.create_task(self._run_media_loader(entry, spill))
+        try:
+            # shield 避免某个等待方被取消时中断其他等待方共享的下载
+            return await asyncio.shield(entry.task)
+        except Exception as e:
+            logger.error(f"按需下载失败: {e}")
+            return None
+
+    async def _run_media_loader(self, entry: MediaEntry, spill: bool) -> Optional[Union[bytes, memoryview]]:
+        try:
+            content = await entry.loader()
+        except Exception:
+            self._discard_failed_entry(entry)
+            raise
+        if not content:
+            self._discard_failed_entry(entry)
+            return None
+        # 数据保存完成后才清除 loader，写盘期间的并发请求仍会等待同一个下载任务
+        await self._store_loaded_content(entry, content, spill)
+        entry.loader = None
+        return content
+
+    def _discard_failed_entry(self, entry: MediaEntry) -> None:
+        """下载失败的条目从所有键下移除，重新发送的同一文件或图片会重新下载"""
+        logger.warning(f"按需下载失败，移除缓存条目: {entry.name or sorted(entry.keys)}")
+        entry.task = None
+        self.media_cache.discard(entry)
+
+    @staticmethod
+    def _is_failed_entry(entry: MediaEntry) -> bool:
+        return entry.content is None and not entry.path and entry.loader is None
+
+    def _should_spill(self, content: Union[bytes, memoryview], spill: bool) -> bool:
+        return spill and len(content) > self.file_spill_threshold_mb * 1024 * 1024
+
+    def _spill_path(self, entry: MediaEntry) -> str:
+        extension = os.path.splitext(entry.name)[1]
+        return os.path.join(self.files_dir, f"{SPILL_FILE_PREFIX}{uuid.uuid4().hex}{extension}")
+
+    @staticmethod
+    def _write_spill_file(path: str, content: Union[bytes, memoryview]) -> None:
+        with open(path, "wb") as f:
+            f.write(content)
+
+    def _set_spilled(self, entry: MediaEntry, path: str) -> None:
+        entry.path = path
+        entry.content = None
+        self.media_cache.update_size(entry, 0)
+        logger.info(f"文件较大，已写入磁盘缓存: {path}")
+
+    def _store_entry_content(self, entry: MediaEntry, content: Union[bytes, memoryview], spill: bool = False) -> None:
+        """写入条目数据，spill 为 True 时超过阈值的数据写入磁盘"""
+        if self._should_spill(content, spill):
+            path = self._spill_path(entry)
+            try:
+                self._write_spill_file(path, content)
+                self._set_spilled(entry, path)
+                return
+            except OSError as e:
+                logger.error(f"写入磁盘缓存失败，改为内存缓存: {e}")
+        entry.content = content
+        self.media_cache.update_size(entry, len(content))
+
+    async def _store_loaded_content(self, entry: MediaEntry, content: Union[bytes, memoryview], spill: bool) -> None:
+        """保存按需下载的数据，大文件在线程中写盘，条目已不在缓存中时只交给等待方而不再保存"""
+        if not entry.keys:
+            logger.debug(f"条目在下载期间已移出缓存，不再保存: {entry.name}")
+            return
+        if self._should_spill(content, spill):
+            path = self._spill_path(entry)
+            try:
+                await asyncio.to_thread(self._write_spill_file, path, content)
+            except OSError as e:
+                logger.error(f"写入磁盘缓存失败，改为内存缓存: {e}")
             else:
-                # 超时清除
-                logger.debug(f"缓存图片超时，已清除")
-                del self.image_cache[user_wxid]
-        else:
-            logger.debug(f"未找到用户 {user_wxid} 的缓存图片")
-        return None
+                if entry.keys:
+                    self._set_spilled(entry, path)
+                    return
+                # 写盘期间条目已过期或被替换，删除刚写入的文件
+                logger.debug(f"条目在写盘期间已移出缓存，删除磁盘缓存: {path}")
+                try:
+                    os.remove(path)
+                except OSError as e:
+                    logger.warning(f"删除磁盘缓存失败: {e}")
+                return
+        entry.content = content
+        self.media_cache.update_size(entry, len(content))
 
-    async def get_cached_file(self, user_wxid: str) -> Optional[tuple[bytes, str, str]]:
+    async def get_cached_file(self, user_wxid: str) -> Optional[tuple[Union[bytes, memoryview], str, str]]:
         """获取用户最近的文件，返回 (文件内容, 文件名, MIME类型)"""
         logger.debug(f"尝试获取用户 {user_wxid} 的缓存文件")
-        if user_wxid in self.file_cache:
-            cache_data = self.file_cache[user_wxid]
-            current_time = time.time()
-            cache_age = current_time - cache_data["timestamp"]
-            logger.debug(f"找到缓存文件，年龄: {cache_age:.2f}秒, 超时时间: {self.file_cache_timeout}秒")
+        cache_data = self.media_cache.get("file", user_wxid)
+        if cache_data is None:
+            logger.debug(f"未找到用户 {user_wxid} 的缓存文件或已超时")
+            return None
 
-            if cache_age <= self.file_cache_timeout:
+        try:
+            # 确保我们有有效的二进制数据
+            file_content = cache_data.content
+            file_name = cache_data.name
+            mime_type = cache_data.mime_type
+
+            # 只记录了元数据的附件，在第一次被查询使用时下载
+            if file_content is None and not cache_data.path and cache_data.loader:
+                logger.info(f"缓存文件尚未下载，开始按需下载: {file_name}")
+                file_content = await self._load_media_entry(cache_data, spill=True)
+                if not file_content:
+                    logger.error(f"按需下载文件失败: {file_name}")
+                    self.media_cache.remove("file", user_wxid)
+                    return None
+                logger.info(f"成功获取用户 {user_wxid} 的缓存文件: {file_name}, 大小: {len(file_content)} 字节")
+                return (file_content, file_name, mime_type)
+
+            # 落盘的大文件通过内存映射读取，不把整个文件读入内存
+            if cache_data.path:
+                file_content = self._entry_content(cache_data)
+                logger.info(f"成功获取用户 {user_wxid} 的落盘缓存文件: {file_name}, 大小: {len(file_content)} 字节")
+                return (file_content, file_name, mime_type)
+
+            # 处理不同类型的文件内容
+            if isinstance(file_content, bytearray):
+                # 以只读视图包装 bytearray，不复制数据
+                file_content = memoryview(file_content).toreadonly()
+            elif isinstance(file_content, str):
+                # 尝试将字符串解析为 base64
                 try:
-                    # 确保我们有有效的二进制数据
-                    file_content = cache_data["content"]
-                    file_name = cache_data["name"]
-                    mime_type = cache_data["mime_type"]
-
-                    # 处理不同类型的文件内容
-                    if isinstance(file_content, bytearray):
-                        # 将 bytearray 转换为 bytes
-                        file_content = bytes(file_content)
-                        logger.info(f"将 bytearray 转换为 bytes，大小: {len(file_content)} 字节")
-                    elif isinstance(file_content, str):
-                        # 尝试将字符串解析为 base64
-                        try:
-                            file_content = base64.b64decode(file_content)
-                            logger.info(f"将 base64 字符串转换为 bytes，大小: {len(file_content)} 字节")
-                        except Exception as e:
-                            logger.error(f"Base64 解码失败: {e}")
-                            file_content = file_content.encode('utf-8')
-                            logger.info(f"将普通字符串转换为 bytes，大小: {len(file_content)} 字节")
-                    elif not isinstance(file_content, bytes):
-                        logger.error(f"缓存的文件内容不是支持的格式: {type(file_content)}")
-                        del self.file_cache[user_wxid]
-                        return None
+                    file_content = base64.b64decode(file_content)
+                    logger.info(f"将 base64 字符串转换为 bytes，大小: {len(file_content)} 字节")
+                except Exception as e:
+                    logger.error(f"Base64 解码失败: {e}")
+                    file_content = file_content.encode('utf-8')
+                    logger.info(f"将普通字符串转换为 bytes，大小: {len(file_content)} 字节")
+            elif not isinstance(file_content, (bytes, memoryview)):
+                logger.error(f"缓存的文件内容不是支持的格式: {type(file_content)}")
+                self.media_cache.remove("file", user_wxid)
+                return None
 
-                    # 更新缓存中的文件内容
-                    self.file_cache[user_wxid]["content"] = file_content
+            # 更新缓存中的文件内容
+            if file_content is not cache_data.content:
+                cache_data.content = file_content
+                self.media_cache.update_size(cache_data, len(file_content))
 
-                    # 更新时间戳，避免过早超时
-                    self.file_cache[user_wxid]["timestamp"] = current_time
-                    logger.info(f"成功获取用户 {user_wxid} 的缓存文件: {file_name}, 大小: {len(file_content)} 字节")
-                    return (file_content, file_name, mime_type)
-                except Exception as e:
-                    logger.error(f"处理缓存文件失败: {e}")
-                    del self.file_cache[user_wxid]
-                    return None
-            else:
-                # 超时清除
-                logger.debug(f"缓存文件超时，已清除")
-                del self.file_cache[user_wxid]
-        else:
-            logger.debug(f"未找到用户 {user_wxid} 的缓存文件")
-        return None
+            logger.info(f"成功获取用户 {user_wxid} 的缓存文件: {file_name}, 大小: {len(file_content)} 字节")
+            return (file_content, file_name, mime_type)
+        except Exception as e:
+            logger.error(f"处理缓存文件失败: {e}")
+            self.media_cache.remove("file", user_wxid)
+            return None
 
-    def cache_file(self, user_wxid: str, file_content: bytes, file_name: str, mime_type: str) -> None:
-        """缓存用户文件"""
-        self.file_cache[user_wxid] = {
-            "content": file_content,
-            "name": file_name,
-            "mime_type": mime_type,
-            "timestamp": time.time()
-        }
-        logger.info(f"已缓存用户 {user_wxid} 的文件: {file_name}, 大小: {len(file_content)} 字节")
+    @staticmethod
+    def _entry_content(entry: MediaEntry) -> Optional[Union[bytes, memoryview]]:
+        """获取缓存条目的数据，落盘条目返回内存映射的只读视图"""
+        if entry.path:
+            # 同一条目复用一个映射，释放条目时由缓存关闭
+            if entry.mapping is None or entry.mapping.closed:
+                with open(entry.path, "rb") as f:
+                    entry.mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            return memoryview(entry.mapping)
+        return entry.content
+
+    def cache_file(self, user_wxids: list[str], file_content: Union[bytes, memoryview], file_name: str, mime_type: str,
+                   attach_keys: list[str] = None) -> None:
+        """缓存用户文件，多个用户ID共享同一份数据，大文件写入磁盘
+
+        attach_keys 为附件去重键，同一附件再次缓存时复用已有条目
+        """
+        attach_keys = attach_keys or []
+        if self._reuse_attachment_entry(user_wxids, attach_keys):
+            logger.info(f"已缓存用户 {', '.join(dict.fromkeys(user_wxids))} 的文件: {file_name}（复用已下载的附件）")
+            return
 
-    async def download_and_send_file(self, bot: WechatAPIClient, message: dict, url: str):
-        """下载并发送文件"""
-        try:
-            # 从URL中获取文件名
-            parsed_url = urllib.parse.urlparse(url)
-            filename = os.path.basename(parsed_url.path)
-            if not filename:
-                filename = "downloaded_file"
-
-            logger.debug(f"开始下载文件: {url}")
-            async with aiohttp.ClientSession(proxy=self.http_proxy) as session:
-                async with session.get(url) as resp:
-                    if resp.status != 200:
-                        await bot.send_text_message(message["FromWxid"], f"下载文件失败: HTTP {resp.status}")
-                        return
+        entry = MediaEntry(name=file_name, mime_type=mime_type, ttl=self.file_cache_timeout)
+        self._store_entry_content(entry, file_content, spill=True)
+        self.media_cache.put("file", user_wxids, entry)
+        if attach_keys:
+            self.media_cache.put("attach", attach_keys, entry)
+        logger.info(f"已缓存用户 {', '.join(dict.fromkeys(user_wxids))} 的文件: {file_name}, 大小: {len(file_content)} 字节")
+
+    def cache_lazy_file(self, user_wxids: list[str], attach_keys: list[str], file_name: str, mime_type: str, loader) -> None:
+        """只记录附件元数据，等到查询需要该文件时再通过 loader 下载"""
+        if self._reuse_attachment_entry(user_wxids, attach_keys):
+            logger.info(f"已记录用户 {', '.join(dict.fromkeys(user_wxids))} 的文件: {file_name}（复用已有的附件）")
+            return
 
-                    content = await resp.read()
+        entry = MediaEntry(name=file_name, mime_type=mime_type, ttl=self.file_cache_timeout, loader=loader)
+        self.media_cache.put("file", user_wxids, entry)
+        if attach_keys:
+            self.media_cache.put("attach", attach_keys, entry)
+        logger.info(f"已记录用户 {', '.join(dict.fromkeys(user_wxids))} 的文件元数据: {file_name}，将在使用时下载")
+
+    def _reuse_attachment_entry(self, user_wxids: list[str], attach_keys: list[str]) -> bool:
+        """同一附件已在缓存中时，把用户ID挂到已有条目上"""
+        for attach_key in attach_keys:
+            entry = self.media_cache.get("attach", attach_key)
+            if entry is not None and self._is_failed_entry(entry):
+                self.media_cache.discard(entry)
+            elif entry is not None:
+                self.media_cache.put("file", user_wxids, entry)
+                self.media_cache.put("attach", attach_keys, entry)
+                return True
+        return False
 
-                    # 检测文件类型
-                    kind = filetype.guess(content)
-                    if kind is None:
-                        # 如果无法检测文件类型,尝试从Content-Type或URL获取
-                        content_type = resp.headers.get('Content-Type', '')
-                        ext = mimetypes.guess_extension(content_type) or os.path.splitext(filename)[1]
-                        if not ext:
-                            await bot.send_text_message(message["FromWxid"], f"无法识别文件类型: {filename}")
-                            return
-                    else:
-                        ext = f".{kind.extension}"
-
-                    # 确保文件名有扩展名
-                    if not os.path.splitext(filename)[1]:
-                        filename = f"{filename}{ext}"
-
-                    # 根据文件类型发送不同类型的消息
-                    if ext.lower() in ['.jpg', '.jpeg', '.png', '.gif', '.bmp']:
-                        await bot.send_image_message(message["FromWxid"], content)
-                    elif ext.lower() in ['.mp3', '.wav', '.ogg', 'm4a']:
-                        await bot.send_voice_message(message["FromWxid"], voice=content, format=ext[1:])
-                    elif ext.lower() in ['.mp4', '.avi', '.mov', '.mkv']:
-                        await bot.send_video_message(message["FromWxid"], video=content, image="None")
-                    else:
-                        # 其他类型文件，发送文件内容
-                        await bot.send_text_message(message["FromWxid"], f"文件名: {filename}\n内容长度: {len(content)} 字节")
+    @staticmethod
+    def _attachment_keys(attach_id: Optional[str], md5: Optional[str], total_len: int) -> list[str]:
+        """生成附件去重键：附件ID，以及 md5+长度（转发的同一文件附件ID可能不同）"""
+        keys = []
+        if attach_id:
+            keys.append(f"id:{attach_id}")
+        if md5 and total_len:
+            keys.append(f"md5:{md5.lower()}:{total_len}")
+        return keys
+
+    async def _get_attachment(self, attach_keys: list[str], loader) -> Optional[Union[bytes, memoryview]]:
+        """获取附件内容：优先使用已缓存的附件，进行中的相同下载直接共享，否则调用 loader 下载"""
+        for attach_key in attach_keys:
+            entry = self.media_cache.get("attach", attach_key)
+            if entry is not None and self._is_failed_entry(entry):
+                self.media_cache.discard(entry)
+            elif entry is not None:
+                logger.info(f"附件已缓存，跳过下载: {attach_key}")
+                if entry.content is None and not entry.path and entry.loader:
+                    return await self._load_media_entry(entry, spill=True)
+                return self._entry_content(entry)
+        for attach_key in attach_keys:
+            task = self.attachment_downloads.get(attach_key)
+            if task is not None:
+                logger.info(f"附件正在下载，等待共享结果: {attach_key}")
+                return await asyncio.shield(task)
+
+        task = asyncio.create_task(loader())
+        for attach_key in attach_keys:
+            self.attachment_downloads[attach_key] = task
+        try:
+            return await asyncio.shield(task)
+        finally:
+            for attach_key in attach_keys:
+                if self.attachment_downloads.get(attach_key) is task:
+                    del self.attachment_downloads[attach_key]
+
+    async def _download_file_attachment(self, bot: WechatAPIClient, attach_id: Optional[str], cdn_url: Optional[str],
+                                        aes_key: Optional[str], total_len: int) -> Optional[Union[bytes, memoryview]]:
+        """依次尝试多种方法下载文件附件，返回二进制内容"""
+        # 尝试不同的下载方法
+        try:
+            file_data = None
 
-                    logger.debug(f"文件 {filename} 发送成功")
+            # 方法1: 如果有附件ID，使用download_attach方法
+            if attach_id:
+                logger.debug(f"方法1: 尝试使用download_attach方法下载文件，附件ID: {attach_id}")
+                file_data = await bot.download_attach(attach_id)
 
+            # 方法3: 如果有CDN URL和AES密钥，使用download_image方法
+            if not file_data and cdn_url and aes_key:
+                logger.debug(f"方法3: 尝试使用download_image方法下载文件，CDN URL: {cdn_url}")
+                try:
+                    image_data = await bot.download_image(aes_key, cdn_url)
+                    if image_data:
+                        if isinstance(image_data, str):
+                            try:
+                                file_data = base64.b64decode(image_data)
+                                logger.info(f"使用download_image成功下载文件，大小: {len(file_data)} 字节")
+                            except Exception as e:
+                                logger.error(f"Base64解码失败: {e}")
+                except Exception as e:
+                    logger.error(f"download_image方法失败: {e}")
+            if not file_data:
+                # 方法2: 使用Tools/DownloadFile API并发分段下载文件
+                logger.debug(f"尝试使用Tools/DownloadFile API分段下载文件")
+                urls = [
+                    f'http://{bot.ip}:{bot.port}/api/Tools/DownloadFile',
+                    f'http://{bot.ip}:{bot.port}/VXAPI/Tools/DownloadFile'
+                ]
+                file_data = await self.attachment_downloader.download(urls, bot.wxid, attach_id, total_len)
+                if file_data is None:
+                    logger.error("所有API端点尝试失败")
         except Exception as e:
-            logger.error(f"下载或发送文件失败: {e}")
-            await bot.send_text_message(message["FromWxid"], f"处理文件失败: {str(e)}")
+            logger.error(f"下载文件异常: {e}")
+            logger.error(traceback.format_exc())
+            file_data = None
+
+        if file_data:
+            # 如果返回的是base64字符串，解码为二进制
+            if isinstance(file_data, str):
+                try:
+                    file_content = base64.b64decode(file_data)
+                except Exception as e:
+                    logger.error(f"Base64解码失败: {e}")
+                    file_content = file_data.encode('utf-8')
+            elif isinstance(file_data, (bytes, memoryview)):
+                file_content = file_data
+            elif isinstance(file_data, dict) and "buffer" in file_data:
+                try:
+                    file_content = base64.b64decode(file_data["buffer"])
+                except Exception as e:
+                    logger.error(f"Buffer Base64解码失败: {e}")
+                    file_content = str(file_data).encode('utf-8')
+            else:
+                file_content = str(file_data).encode('utf-8')
+
+            return file_content
+        return None
+
+    async def download_and_send_file(self, bot: WechatAPIClient, message: dict, url: str):
+        """下载并发送文件"""
+        link = ResponseLink(url, is_file=True)
+        await self._send_response_link(bot, message, link, await self._fetch_response_link(link))
 
     @on_xml_message(priority=98)  # 使用高优先级确保先处理
     async def handle_xml_file(self, bot: WechatAPIClient, message: dict):
@@ -2255,8 +3676,12 @@ class Dify(PluginBase):
                 logger.info("Dify: 检测到引用消息，使用普通文本处理")
                 return True
 
+            # 先做字符串级别的快速检查，非文件类型的XML消息不构建解析树
+            if not XML_FILE_TYPE_PATTERN.search(content):
+                return True
+
             # 解析XML内容
-            root = ET.fromstring(message["Content"])
+            root = self._parse_xml(content)
             appmsg = root.find("appmsg")
             if appmsg is None:
                 return True
@@ -2284,126 +3709,52 @@ class Dify(PluginBase):
                 logger.info(f"Dify: 附件ID: {attach_id}")
                 logger.info(f"Dify: 文件大小: {total_len}")
 
-                # 发送通知
-                await bot.send_text_message(
-                    message["FromWxid"],
-                    f"Dify: 正在下载文件..."
-                )
+                # 确定文件类型
+                mime_type = mimetypes.guess_type(f"{title}.{file_extend}")[0] or "application/octet-stream"
 
-                # 使用 /Tools/DownloadFile API 下载文件
-                logger.info("Dify: 开始下载文件...")
-                # 分段下载大文件
-                # 每次下载 64KB
-                chunk_size = 64 * 1024  # 64KB
-                app_id = appmsg.get("appid", "")
-
-                # 创建一个字节数组来存储完整的文件数据
-                file_data = bytearray()
+                # 处理文件名，避免重复的扩展名
+                if title.lower().endswith(f".{file_extend.lower()}"):
+                    file_name = title  # 如果标题已经包含扩展名，直接使用
+                else:
+                    file_name = f"{title}.{file_extend}"  # 否则添加扩展名
 
-                # 计算需要下载的分段数量
-                chunks = (total_len + chunk_size - 1) // chunk_size  # 向上取整
+                logger.info(f"Dify: 处理后的文件名: {file_name}")
 
-                logger.info(f"Dify: 开始分段下载文件，总大小: {total_len} 字节，分 {chunks} 段下载")
+                from_wxid = message["FromWxid"]
+                sender_wxid = message.get("SenderWxid", from_wxid)
+                app_id = appmsg.get("appid", "")
 
-                # 尝试两个不同的API端点
+                # 两个API端点按分段互为备用
                 urls = [
                     f'http://127.0.0.1:9011/api/Tools/DownloadFile',
                     f'http://127.0.0.1:9011/VXAPI/Tools/DownloadFile'
                 ]
 
-                download_success = False
-
-                for url in urls:
-                    if download_success:
-                        break
+                # 同一附件（相同附件ID或 md5+长度）的并发和重复请求共享一次下载
+                md5_element = appmsg.find("md5")
+                md5 = md5_element.text.strip() if md5_element is not None and md5_element.text else None
+                attach_keys = self._attachment_keys(attach_id, md5, total_len)
+                loader = functools.partial(self.attachment_downloader.download, urls, bot.wxid, attach_id, total_len, app_id)
 
-                    file_data.clear()  # 清空之前的数据
-                    logger.info(f"Dify: 尝试使用 {url} 下载文件")
-
-                    # 分段下载
-                    for i in range(chunks):
-                        start_pos = i * chunk_size
-                        # 最后一段可能不足 chunk_size
-                        current_chunk_size = min(chunk_size, total_len - start_pos)
-
-                        logger.info(f"Dify: 下载第 {i+1}/{chunks} 段，起始位置: {start_pos}，大小: {current_chunk_size} 字节")
-
-                        async with aiohttp.ClientSession() as session:
-                            # 设置较长的超时时间
-                            timeout = aiohttp.ClientTimeout(total=60)  # 1分钟
-
-                            # 构造请求参数
-                            json_param = {
-                                "AppID": app_id,
-                                "AttachId": attach_id,
-                                "DataLen": total_len,
-                                "Section": {
-                                    "DataLen": current_chunk_size,
-                                    "StartPos": start_pos
-                                },
-                                "UserName": "",  # 可选参数
-                                "Wxid": bot.wxid
-                            }
-
-                            logger.info(f"Dify: 调用下载文件API: AttachId={attach_id}, 起始位置: {start_pos}, 大小: {current_chunk_size}")
-                            response = await session.post(
-                                url,
-                                json=json_param,
-                                timeout=timeout
-                            )
+                # 按需下载模式只记录附件信息，有查询使用该文件时再下载
+                if self.file_lazy_download:
+                    # 条目同时挂在附件去重键下，重复的附件由条目自身的单次加载去重
+                    self.cache_lazy_file([sender_wxid, from_wxid], attach_keys, file_name, mime_type, loader)
+                    return True
 
-                            # 处理响应
-                            try:
-                                json_resp = await response.json()
-
-                                if json_resp.get("Success"):
-                                    data = json_resp.get("Data")
-
-                                    # 尝试从不同的响应格式中获取文件数据
-                                    chunk_data = None
-                                    if isinstance(data, dict):
-                                        if "buffer" in data:
-                                            chunk_data = base64.b64decode(data["buffer"])
-                                        elif "data" in data and isinstance(data["data"], dict) and "buffer" in data["data"]:
-                                            chunk_data = base64.b64decode(data["data"]["buffer"])
-                                        else:
-                                            try:
-                                                chunk_data = base64.b64decode(str(data))
-                                            except:
-                                                logger.error(f"Dify: 无法解析文件数据: {data}")
-                                    elif isinstance(data, str):
-                                        try:
-                                            chunk_data = base64.b64decode(data)
-                                        except:
-                                            logger.error(f"Dify: 无法解析文件数据字符串")
-
-                                    if chunk_data:
-                                        # 将分段数据添加到完整文件中
-                                        file_data.extend(chunk_data)
-                                        logger.info(f"Dify: 第 {i+1}/{chunks} 段下载成功，大小: {len(chunk_data)} 字节")
-                                    else:
-                                        logger.warning(f"Dify: 第 {i+1}/{chunks} 段数据为空")
-                                        break
-                                else:
-                                    error_msg = json_resp.get("Message", "Unknown error")
-                                    logger.error(f"Dify: 第 {i+1}/{chunks} 段下载失败: {error_msg}")
-                                    break
-                            except Exception as e:
-                                logger.error(f"Dify: 解析第 {i+1}/{chunks} 段响应失败: {e}")
-                                break
+                # 发送通知
+                await bot.send_text_message(
+                    message["FromWxid"],
+                    f"Dify: 正在下载文件..."
+                )
 
-                    # 检查文件是否下载完整
-                    if len(file_data) > 0:
-                        logger.info(f"Dify: 文件下载成功: AttachId={attach_id}, 实际大小: {len(file_data)} 字节")
-                        download_success = True
-                        break
-                    else:
-                        logger.warning("Dify: 文件数据为空，尝试下一个API端点")
+                # 使用 /Tools/DownloadFile API 并发分段下载文件
+                logger.info("Dify: 开始下载文件...")
+                file_data = await self._get_attachment(attach_keys, loader)
+                download_success = file_data is not None
 
                 # 如果文件下载成功
                 if download_success:
-                    # 确定文件类型
-                    mime_type = mimetypes.guess_type(f"{title}.{file_extend}")[0] or "application/octet-stream"
 
                     # 确保文件数据是二进制格式
                     if isinstance(file_data, str):
@@ -2413,28 +3764,12 @@ class Dify(PluginBase):
                         except Exception as e:
                             logger.error(f"Dify: Base64解码失败: {e}")
                             binary_file_data = file_data.encode('utf-8')
-                    elif isinstance(file_data, bytearray):
-                        binary_file_data = bytes(file_data)
-                        logger.info(f"Dify: 将bytearray转换为二进制数据，大小: {len(binary_file_data)} 字节")
                     else:
+                        # 下载器返回缓冲区的只读视图，直接缓存不再复制
                         binary_file_data = file_data
 
-                    # 处理文件名，避免重复的扩展名
-                    if title.lower().endswith(f".{file_extend.lower()}"):
-                        file_name = title  # 如果标题已经包含扩展名，直接使用
-                    else:
-                        file_name = f"{title}.{file_extend}"  # 否则添加扩展名
-
-                    logger.info(f"Dify: 处理后的文件名: {file_name}")
-
-                    # 缓存文件
-                    from_wxid = message["FromWxid"]
-                    sender_wxid = message.get("SenderWxid", from_wxid)
-                    self.cache_file(sender_wxid, binary_file_data, file_name, mime_type)
-
-                    # 如果是私聊，也缓存到聊天对象的ID
-                    if from_wxid != sender_wxid:
-                        self.cache_file(from_wxid, binary_file_data, file_name, mime_type)
+                    # 缓存文件，发送者和聊天对象共享同一份缓存
+                    self.cache_file([sender_wxid, from_wxid], binary_file_data, file_name, mime_type, attach_keys)
 
                     # 发送下载成功通知
                     await bot.send_text_message(
@@ -2471,6 +3806,7 @@ class Dify(PluginBase):
             file_content = message.get("Content")
 
             logger.info(f"收到文件消息: MsgId={msg_id}, FromWxid={from_wxid}, SenderWxid={sender_wxid}")
+            attach_keys = []  # 附件去重键，仅XML文件消息可用
 
             # 如果Content是二进制数据，直接使用
             if isinstance(file_content, bytes) and len(file_content) > 0:
@@ -2495,21 +3831,20 @@ class Dify(PluginBase):
             elif isinstance(file_content, str) and ("<appmsg" in file_content or "<msg>" in file_content):
                 logger.info("文件内容是XML格式，尝试解析并下载文件")
                 try:
-                    # 解析XML
-                    import xml.etree.ElementTree as ET
-                    import mimetypes
-                    import base64
-
-                    # 处理可能的XML格式差异
+                    # 处理可能的XML格式差异，优先复用其他处理器已解析的结果
                     if "<msg>" in file_content and "<appmsg" in file_content:
-                        # 提取<appmsg>部分
-                        start = file_content.find("<appmsg")
-                        end = file_content.find("</appmsg>") + 9
-                        appmsg_xml = file_content[start:end]
-                        root = ET.fromstring(f"<root>{appmsg_xml}</root>")
-                        appmsg = root.find('appmsg')
+                        try:
+                            root = self._parse_xml(file_content)
+                            appmsg = root.find('appmsg')
+                        except ET.ParseError:
+                            # 完整消息无法解析时只提取<appmsg>部分
+                            start = file_content.find("<appmsg")
+                            end = file_content.find("</appmsg>") + 9
+                            appmsg_xml = file_content[start:end]
+                            root = ET.fromstring(f"<root>{appmsg_xml}</root>")
+                            appmsg = root.find('appmsg')
                     else:
-                        root = ET.fromstring(file_content)
+                        root = self._parse_xml(file_content)
                         appmsg = root.find('.//appmsg')
 
                     if appmsg is not None:
@@ -2537,6 +3872,10 @@ class Dify(PluginBase):
                             # 获取文件大小
                             total_len = int(totallen.text) if totallen is not None and totallen.text and totallen.text.isdigit() else 0
 
+                            # 获取文件MD5，用于识别转发的同一文件
+                            md5_element = appmsg.find('.//md5')
+                            md5 = md5_element.text.strip() if md5_element is not None and md5_element.text else None
+
                             # 获取附件ID和其他下载所需信息
                             attach_id = None
                             cdn_url = None
@@ -2559,152 +3898,18 @@ class Dify(PluginBase):
                                 # 开始下载文件
                                 logger.info(f"开始下载文件: {file_name}, 大小: {total_len} 字节")
 
-                                # 尝试不同的下载方法
-                                try:
-                                    file_data = None
-
-                                    # 方法1: 如果有附件ID，使用download_attach方法
-                                    if attach_id:
-                                        logger.debug(f"方法1: 尝试使用download_attach方法下载文件，附件ID: {attach_id}")
-                                        file_data = await bot.download_attach(attach_id)
-
-                                    # 方法3: 如果有CDN URL和AES密钥，使用download_image方法
-                                    if not file_data and cdn_url and aes_key:
-                                        logger.debug(f"方法3: 尝试使用download_image方法下载文件，CDN URL: {cdn_url}")
-                                        try:
-                                            image_data = await bot.download_image(aes_key, cdn_url)
-                                            if image_data:
-                                                if isinstance(image_data, str):
-                                                    try:
-                                                        file_data = base64.b64decode(image_data)
-                                                        logger.info(f"使用download_image成功下载文件，大小: {len(file_data)} 字节")
-                                                    except Exception as e:
-                                                        logger.error(f"Base64解码失败: {e}")
-                                        except Exception as e:
-                                            logger.error(f"download_image方法失败: {e}")
-                                    if not file_data:
-                                        # 方法2: 使用Tools/DownloadFile API分段下载文件
-                                        logger.debug(f"尝试使用Tools/DownloadFile API分段下载文件")
-
-                                        # 分段下载大文件
-                                        chunk_size = 64 * 1024  # 64KB
-                                        chunks = (total_len + chunk_size - 1) // chunk_size  # 向上取整
-                                        file_data_bytes = bytearray()
-                                        download_success = False
-
-                                        # 尝试两个不同的API端点
-                                        urls = [
-                                            f'http://{bot.ip}:{bot.port}/api/Tools/DownloadFile',
-                                            f'http://{bot.ip}:{bot.port}/VXAPI/Tools/DownloadFile'
-                                        ]
-
-                                        # 尝试每个API端点
-                                        for url in urls:
-                                            if download_success:
-                                                break
-
-                                            logger.info(f"尝试使用 {url} 分段下载文件，总大小: {total_len} 字节，分 {chunks} 段下载")
-                                            file_data_bytes.clear()  # 清空之前的数据
-
-                                            try:
-                                                async with aiohttp.ClientSession() as session:
-                                                    # 分段下载
-                                                    for i in range(chunks):
-                                                        start_pos = i * chunk_size
-                                                        # 最后一段可能不足 chunk_size
-                                                        current_chunk_size = min(chunk_size, total_len - start_pos)
-
-                                                        logger.debug(f"下载第 {i+1}/{chunks} 段，起始位置: {start_pos}，大小: {current_chunk_size} 字节")
-
-                                                        # 构造请求参数
-                                                        json_param = {
-                                                            "AppID": "",  # 可选参数
-                                                            "AttachId": attach_id,
-                                                            "DataLen": total_len,
-                                                            "Section": {
-                                                                "DataLen": current_chunk_size,
-                                                                "StartPos": start_pos
-                                                            },
-                                                            "UserName": "",  # 可选参数
-                                                            "Wxid": bot.wxid
-                                                        }
-
-                                                        # 设置较长的超时时间
-                                                        timeout = aiohttp.ClientTimeout(total=60)  # 1分钟
-
-                                                        # 发送请求
-                                                        try:
-                                                            async with session.post(url, json=json_param, timeout=timeout) as resp:
-                                                                if resp.status == 200:
-                                                                    resp_json = await resp.json()
-                                                                    if resp_json.get("Success"):
-                                                                        data = resp_json.get("Data")
-                                                                        if isinstance(data, str):
-                                                                            try:
-                                                                                chunk_data = base64.b64decode(data)
-                                                                                file_data_bytes.extend(chunk_data)
-                                                                                logger.debug(f"第 {i+1}/{chunks} 段下载成功，大小: {len(chunk_data)} 字节")
-                                                                            except Exception as e:
-                                                                                logger.error(f"Base64解码失败: {e}")
-                                                                                break
-                                                                        elif isinstance(data, dict) and "buffer" in data:
-                                                                            try:
-                                                                                chunk_data = base64.b64decode(data["buffer"])
-                                                                                file_data_bytes.extend(chunk_data)
-                                                                                logger.debug(f"第 {i+1}/{chunks} 段下载成功，大小: {len(chunk_data)} 字节")
-                                                                            except Exception as e:
-                                                                                logger.error(f"Buffer Base64解码失败: {e}")
-                                                                                break
-                                                                        else:
-                                                                            logger.warning(f"无法解析响应数据: {data}")
-                                                                            break
-                                                                    else:
-                                                                        logger.warning(f"API返回错误: {resp_json}")
-                                                                        break
-                                                                else:
-                                                                    logger.warning(f"API请求失败: {resp.status}")
-                                                                    break
-                                                        except Exception as e:
-                                                            logger.error(f"下载第 {i+1}/{chunks} 段时出错: {e}")
-                                                            break
-
-                                                    # 检查文件是否下载完整
-                                                    if len(file_data_bytes) > 0:
-                                                        logger.info(f"文件分段下载成功，实际大小: {len(file_data_bytes)} 字节")
-                                                        file_data = base64.b64encode(file_data_bytes).decode('utf-8')
-                                                        download_success = True
-                                                        break
-                                                    else:
-                                                        logger.warning(f"文件下载失败，数据为空")
-                                            except Exception as e:
-                                                logger.error(f"尝试使用 {url} 分段下载文件时出错: {e}")
-                                                logger.error(traceback.format_exc())
-
-                                        # 如果所有尝试都失败
-                                        if not download_success:
-                                            logger.error("所有API端点尝试失败")
-                                except Exception as e:
-                                    logger.error(f"下载文件异常: {e}")
-                                    logger.error(traceback.format_exc())
-                                    file_data = None
-
-                                if file_data:
-                                    # 如果返回的是base64字符串，解码为二进制
-                                    if isinstance(file_data, str):
-                                        try:
-                                            file_content = base64.b64decode(file_data)
-                                        except Exception as e:
-                                            logger.error(f"Base64解码失败: {e}")
-                                            file_content = file_data.encode('utf-8')
-                                    elif isinstance(file_data, dict) and "buffer" in file_data:
-                                        try:
-                                            file_content = base64.b64decode(file_data["buffer"])
-                                        except Exception as e:
-                                            logger.error(f"Buffer Base64解码失败: {e}")
-                                            file_content = str(file_data).encode('utf-8')
-                                    else:
-                                        file_content = str(file_data).encode('utf-8')
+                                # 同一附件的并发和重复请求共享一次下载
+                                attach_keys = self._attachment_keys(attach_id, md5, total_len)
+                                loader = functools.partial(self._download_file_attachment, bot, attach_id, cdn_url, aes_key, total_len)
+
+                                # 按需下载模式只记录附件信息，有查询使用该文件时再下载
+                                if self.file_lazy_download:
+                                    self.cache_lazy_file([sender_wxid, from_wxid], attach_keys, file_name, mime_type, loader)
+                                    return
+
+                                file_content = await self._get_attachment(attach_keys, loader)
 
+                                if file_content:
                                     logger.info(f"文件下载成功，大小: {len(file_content)} 字节")
                                 else:
                                     logger.error("文件下载失败或内容为空")
@@ -2733,11 +3938,8 @@ class Dify(PluginBase):
                 return
 
             # 缓存文件
-            self.cache_file(sender_wxid, file_content, file_name, mime_type)
-
-            # 如果是私聊，也缓存到聊天对象的ID
-            if from_wxid != sender_wxid:
-                self.cache_file(from_wxid, file_content, file_name, mime_type)
+            # 发送者和聊天对象共享同一份缓存
+            self.cache_file([sender_wxid, from_wxid], file_content, file_name, mime_type, attach_keys)
 
             # 发送确认消息
             await bot.send_text_message(from_wxid, f"已收到文件: {file_name}\n大小: {len(file_content)/1024:.2f} KB\n类型: {mime_type}\n\n文件已缓存，在接下来的5分钟内与我对话时将自动包含此文件。")